@@ -0,0 +1,216 @@
+import os
+import json
+import contextlib
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ===== Balance ledger =====
+# last_balance.json keeps the latest closing balance per account (same format as
+# before); balance_history.json keeps every closing balance with its statement
+# date. Updates are collected in a BalanceLedger and committed once per run:
+# under a file lock, re-read, merged and written with write-then-rename, so
+# parallel extraction runs cannot lose each other's updates.
+
+BALANCE_FILE = "last_balance.json"
+BALANCE_BACKUP_FILE = "last_balance_backup.json"
+BALANCE_HISTORY_FILE = "balance_history.json"
+BALANCE_LOCK_FILE = "last_balance.lock"
+
+@contextlib.contextmanager
+def _locked(lock_path):
+    with open(lock_path, "a+") as lock:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _read_json(path):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_balances():
+    """Latest closing balance per account: {account_id: balance}."""
+    return _read_json(BALANCE_FILE)
+
+def load_balance_history():
+    """All recorded closing balances: {account_id: [{"date", "balance", "source"}, ...]}, oldest first."""
+    return _read_json(BALANCE_HISTORY_FILE)
+
+class BalanceLedger:
+    def __init__(self):
+        self.pending = []
+
+    def record(self, account_id, balance, statement_date=None, source=None):
+        self.pending.append({
+            "account": account_id,
+            "balance": balance,
+            "date": statement_date or date.today().isoformat(),
+            "source": source,
+        })
+
+    def commit(self):
+        """Merge the pending balances into the ledger files; returns the number written."""
+        if not self.pending:
+            return 0
+        with _locked(BALANCE_LOCK_FILE):
+            old_balances = load_balances()
+            history = load_balance_history()
+            for entry in self.pending:
+                account_history = history.setdefault(entry["account"], [])
+                # One closing balance per account and statement date; a re-extracted statement replaces it
+                account_history[:] = [h for h in account_history if h["date"] != entry["date"]]
+                account_history.append({k: entry[k] for k in ("date", "balance", "source")})
+                account_history.sort(key=lambda h: h["date"])
+
+            balances = dict(old_balances)
+            for entry in self.pending:
+                balances[entry["account"]] = history[entry["account"]][-1]["balance"]
+
+            if old_balances:
+                _write_json_atomic(BALANCE_BACKUP_FILE, old_balances)
+            _write_json_atomic(BALANCE_HISTORY_FILE, history)
+            _write_json_atomic(BALANCE_FILE, balances)
+        written = len(self.pending)
+        self.pending = []
+        return written
+
+def update_balance_for_account(account_id, latest_balance, statement_date=None, ledger=None, source=None):
+    """Record a closing balance; without a ledger it is written right away."""
+    if ledger is None:
+        ledger = BalanceLedger()
+        ledger.record(account_id, latest_balance, statement_date, source)
+        ledger.commit()
+        print(f"Updated balance for {account_id}: {latest_balance}")
+    else:
+        ledger.record(account_id, latest_balance, statement_date, source)
+
+# ===== Running balances =====
+
+def _balance_anchors(history, balances, work):
+    """Closing balances as a frame of (account, date, balance), oldest first."""
+    rows = [
+        (account, h["date"], h["balance"])
+        for account, entries in history.items()
+        for h in entries
+    ]
+    # last_balance.json entries from before the history existed have no date:
+    # take them as the closing balance after the account's latest booking
+    last_booked = work.groupby("account")["date"].max()
+    for account, balance in balances.items():
+        if account not in history and account in last_booked.index:
+            rows.append((account, last_booked[account], balance))
+    anchors = pd.DataFrame(rows, columns=["account", "date", "balance"])
+    anchors["account"] = anchors["account"].astype(str)
+    anchors["date"] = pd.to_datetime(anchors["date"], errors="coerce").astype("datetime64[ns]")
+    anchors["balance"] = pd.to_numeric(anchors["balance"], errors="coerce")
+    return anchors.dropna().sort_values("date", kind="stable", ignore_index=True)
+
+_BALANCE_INPUTS = {"Reference Account", "Booking Date", "Amount (€)"}
+
+def _balance_work(df):
+    """Rows of df with a usable booking date as (account, date, amount, pos), in booking-date order (file order within a day)."""
+    work = pd.DataFrame({
+        "account": df["Reference Account"].astype(str).to_numpy(),
+        "date": pd.to_datetime(df["Booking Date"].astype(str).str[:10], format="%Y-%m-%d", errors="coerce")
+                  .astype("datetime64[ns]").to_numpy(),
+        "amount": pd.to_numeric(df["Amount (€)"], errors="coerce").fillna(0.0).to_numpy(),
+        "pos": np.arange(len(df)),
+    })
+    work = work[work["date"].notna()]
+    # merge_asof wants the rows sorted on the date; a stable sort keeps file order within a day
+    return work.sort_values(["date", "pos"], kind="stable", ignore_index=True)
+
+def account_balance_states(df, history=None, balances=None):
+    """Per account of df: first and last booking date, the running total after its last row and its closing balances.
+
+    The total is summed in the same order as in reconstruct_running_balances,
+    so adding later rows to it gives exactly their running totals over the
+    whole history. The closing balances are the ones reconstruct_running_balances
+    uses for df, as [(date, balance)], oldest first.
+    """
+    if df.empty or not _BALANCE_INPUTS.issubset(df.columns):
+        return pd.DataFrame(columns=["first_date", "last_date", "total", "anchors"])
+    if history is None:
+        history = load_balance_history()
+    if balances is None:
+        balances = load_balances()
+    work = _balance_work(df)
+    by_account = {}
+    for account, anchor_date, balance in _balance_anchors(history, balances, work).itertuples(index=False):
+        by_account.setdefault(account, []).append((anchor_date, balance))
+    work["cum"] = work.groupby("account", sort=False)["amount"].cumsum()
+    states = work.groupby("account", sort=False).agg(
+        first_date=("date", "min"), last_date=("date", "max"), total=("cum", "last"))
+    states["anchors"] = [by_account.get(account, []) for account in states.index]
+    return states
+
+def reconstruct_running_balances(df, history=None, balances=None):
+    """Fill 'Balance (€)' for every account that has a recorded closing balance.
+
+    Within each 'Reference Account', rows are taken in booking-date order
+    (file order within a day). The balance after a row is the closing balance
+    of the first statement dated on or after it, minus everything booked after
+    the row up to that statement date; rows newer than every statement carry
+    on from the latest closing balance. Rows without a usable account, date or
+    closing balance keep their current value.
+    """
+    if history is None:
+        history = load_balance_history()
+    if balances is None:
+        balances = load_balances()
+    if df.empty or not _BALANCE_INPUTS.issubset(df.columns) or not (history or balances):
+        return df
+
+    work = _balance_work(df)
+    anchors = _balance_anchors(history, balances, work)
+    work = work[work["account"].isin(anchors["account"])].reset_index(drop=True)
+    if work.empty:
+        return df
+
+    work["cum"] = work.groupby("account", sort=False)["amount"].cumsum()
+
+    # Running total at each statement date -> offset between running total and balance
+    at_anchor = pd.merge_asof(anchors, work[["date", "account", "cum"]], on="date", by="account", direction="backward")
+    at_anchor["offset"] = at_anchor["balance"] - at_anchor["cum"].fillna(0.0)
+    offsets = at_anchor[["date", "account", "offset"]]
+
+    offset = pd.merge_asof(work, offsets, on="date", by="account", direction="forward")["offset"]
+    later = offset.isna().to_numpy()
+    if later.any():
+        offset[later] = pd.merge_asof(work[later], offsets, on="date", by="account", direction="backward")["offset"].to_numpy()
+
+    balance = (work["cum"] + offset).round(2).to_numpy()
+    if "Balance (€)" in df.columns:
+        filled = pd.to_numeric(df["Balance (€)"], errors="coerce").to_numpy(dtype="float64", copy=True)
+    else:
+        filled = np.full(len(df), np.nan)
+    filled[work["pos"].to_numpy()] = balance
+    df = df.copy()
+    df["Balance (€)"] = filled
+    return df
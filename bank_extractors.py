@@ -1,421 +1,647 @@
 # Start pasting your extractor functions here
 import re
 import pdfplumber
+import openpyxl
 import pandas as pd
 from datetime import datetime
 import json
 import os
-
-# ===== Shared balance helpers (define ONCE at the top of bank_extractors.py) =====
-
-BALANCE_FILE = "last_balance.json"
-BALANCE_BACKUP_FILE = "last_balance_backup.json"
-
-def load_balances():
-    if os.path.exists(BALANCE_FILE):
-        with open(BALANCE_FILE, "r") as f:
+import hashlib
+from collections import OrderedDict, deque
+
+# Bump when a change to the extractors alters their output, so that
+# process_all_transactions re-extracts statements processed by an older version.
+EXTRACTOR_VERSION = "2"
+
+# Extractors only return their DataFrame; writing it out is up to the caller.
+# Set EXTRACTOR_DEBUG=1 to get the per-block/per-statement debug output back.
+DEBUG = os.getenv("EXTRACTOR_DEBUG") == "1"
+
+def _debug(*args):
+    if DEBUG:
+        print(*args)
+
+# Shared balance helpers live in balance_ledger.py. Each extractor takes an
+# optional BalanceLedger: with one, the closing balance is only recorded and
+# the caller commits all balances of a run at once. The PDF extractors also
+# take the statement's text lines directly (lines=...), as detect_bank does;
+# pdf_path is then only used as the balance source name.
+from balance_ledger import update_balance_for_account
+
+# ===== Shared PDF page cache =====
+# detect_bank and the extractors both read pages through read_pdf_lines, so a
+# statement is laid out by pdfplumber only once per run. Pages are cached by the
+# file's content hash; set PAGE_CACHE_DIR to also keep the page texts on disk,
+# so re-runs after a parser fix skip pdfplumber completely.
+
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR")
+PAGE_CACHE_SIZE = 8  # documents kept in memory
+
+_page_cache = OrderedDict()  # sha256 -> {"pages": [...], "complete": bool}
+_hash_cache = {}  # (path, size, mtime_ns) -> sha256
+
+def file_sha256(path):
+    st = os.stat(path)
+    stat_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if stat_key not in _hash_cache:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _hash_cache[stat_key] = h.hexdigest()
+    return _hash_cache[stat_key]
+
+def remember_file_sha256(path, sha256, size, mtime_ns):
+    """Record the hash of path computed elsewhere (e.g. by the parent process), valid while size and mtime match."""
+    _hash_cache[(os.path.abspath(path), size, mtime_ns)] = sha256
+
+def _load_cached_pages(key):
+    if not PAGE_CACHE_DIR:
+        return None
+    cache_path = os.path.join(PAGE_CACHE_DIR, f"{key}.json")
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
             return json.load(f)
-    return {}
-
-def save_balances(balances):
-    with open(BALANCE_FILE, "w") as f:
-        json.dump(balances, f, indent=2)
-    with open(BALANCE_BACKUP_FILE, "w") as f:
-        json.dump(balances, f, indent=2)
-
-def update_balance_for_account(account_id, latest_balance):
-    balances = load_balances()
-    balances[account_id] = latest_balance
-    save_balances(balances)
-    print(f"Updated balance for {account_id}: {latest_balance}")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def _store_cached_pages(key, pages):
+    if not PAGE_CACHE_DIR:
+        return
+    os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(PAGE_CACHE_DIR, f"{key}.json")
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(pages, f, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+
+def iter_pdf_pages(pdf_path, max_pages=None):
+    """Yield the extracted text of each page ('' for empty pages), one page at a time.
+
+    Only the pages asked for are laid out; pages already extracted for the same
+    file content (e.g. the first two pages read by detect_bank) are reused.
+    pdfplumber's layout objects are released after each page, so only the
+    page texts stay in memory.
+    """
+    key = file_sha256(pdf_path)
+    entry = _page_cache.get(key)
+    if entry is None:
+        pages = _load_cached_pages(key)
+        entry = {"pages": pages or [], "complete": pages is not None}
+        _page_cache[key] = entry
+    _page_cache.move_to_end(key)
+    while len(_page_cache) > PAGE_CACHE_SIZE:
+        _page_cache.popitem(last=False)
+
+    pages = entry["pages"]
+    yield from pages[:max_pages]
+    have = len(pages)
+    if entry["complete"] or (max_pages is not None and have >= max_pages):
+        return
+    with pdfplumber.open(pdf_path) as pdf:
+        total = len(pdf.pages)
+        stop = total if max_pages is None else min(max_pages, total)
+        for i in range(have, stop):
+            page = pdf.pages[i]
+            text = page.extract_text() or ""
+            page.close()
+            if len(pages) == i:
+                pages.append(text)
+            yield text
+        if len(pages) >= total:
+            entry["complete"] = True
+            _store_cached_pages(key, pages)
+
+def read_pdf_pages(pdf_path, max_pages=None):
+    return list(iter_pdf_pages(pdf_path, max_pages))
+
+def iter_pdf_lines(pdf_path, max_pages=None):
+    for text in iter_pdf_pages(pdf_path, max_pages):
+        if text:
+            yield from text.split('\n')
+
+def read_pdf_lines(pdf_path, max_pages=None):
+    return list(iter_pdf_lines(pdf_path, max_pages))
+
+# ===== Transaction sink =====
+# The extractors yield one dict per transaction; collect_transactions turns them
+# into DataFrame chunks as they arrive, so only TRANSACTION_CHUNK_SIZE dicts are
+# alive at any time no matter how long the statement is.
+
+TRANSACTION_CHUNK_SIZE = 5000
+
+def collect_transactions(transactions, chunk_size=None):
+    chunk_size = chunk_size or TRANSACTION_CHUNK_SIZE
+    chunks = []
+    rows = []
+    for tx in transactions:
+        rows.append(tx)
+        if len(rows) >= chunk_size:
+            chunks.append(pd.DataFrame(rows))
+            rows = []
+    if rows or not chunks:
+        chunks.append(pd.DataFrame(rows))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
+
+# ===== Precompiled line patterns =====
+# Each extractor walks its lines once; every pattern used in that pass is
+# compiled here instead of inside the per-line loops.
+
+_WHITESPACE = re.compile(r"\s+")
+_IBAN_DE = re.compile(r'DE\d{20}')
+
+_DKB_HEADER_LINES = 50
+_DKB_TX_DATE = re.compile(r"^(\d{2}\.\d{2}\.\d{4})")
+_DKB_BALANCE = re.compile(r"([\d\.,]+)\s*(EUR)?\s*$")
+_DKB_BALANCE_DATE = re.compile(r"Kontostand am\s+(\d{2}\.\d{2}\.\d{4})")
+_DKB_AMOUNT = re.compile(r'[-+]?\d{1,3}(?:\.\d{3})*,\d{2}')
+_DKB_LINE_AMOUNT = re.compile(r'-?\d{1,3}(?:\.\d{3})*,\d{2}')
+_DKB_REFERENCE_NUMBER = re.compile(r'\d{5,}')
+_DKB_STOP_WORDS = ('Kd.', 'Kunden', 'RG-N', 'Rechnung', 'Gläubiger-ID:', 'KM-', 'EUR', 'r.F', 'IBAN')
+_DKB_TX_TYPES = (
+    (("geldautomat",), "Cash Withdrawal"),
+    (("dauerauftrag",), "Standing Order"),
+    (("überweisung",), "Bank Transfer"),
+    (("basislastschrift", "lastschrift"), "SEPA Direct Debit"),
+    (("zins", "gebühr", "interest"), "Interest/Fee"),
+    (("karte", "kartenzahlung", "debitk"), "Card Payment"),
+    (("lohn", "gehalt", "rente"), "Bank Transfer"),
+)
+
+_N26_IBAN_GROUP = r'(DE\d{2}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{2})'
+_N26_IBAN_LABEL = re.compile(r'IBAN:\s*' + _N26_IBAN_GROUP)
+_N26_IBAN = re.compile(_N26_IBAN_GROUP)
+_N26_TX = re.compile(r'(.+?)\s+(\d{2}\.\d{2}\.\d{4})\s+([+-]?\d{1,3}(?:\.\d{3})*,\d{2})€')
+_N26_BALANCE = re.compile(r'Dein neuer Kontostand\s*([+-]?\d{1,3}(?:\.\d{3})*,\d{2})€')
+_N26_IBAN_LOOKAHEAD = 4  # lines after a transaction searched for its IBAN
+
+_DB_BALANCE = re.compile(r'^EUR\s*([+-]?[\d\.,]+)$')
+_DB_AMOUNT = re.compile(r'([+-]?\d+(?:\.\d{3})*\.\d{2})$')
+_DB_VALUE_DATE = re.compile(r'.*?(\d{2}-\d{2}-)\s*(\d{2}-\d{2}-)')
+_DB_YEAR_PAYEE = re.compile(r'(\d{4})\s+\d{4}\s+(.+)')
+_DB_IBAN_LOOKAHEAD = 5  # lines after the payee line searched for the counterparty IBAN
+_DB_TX_TYPES = (
+    ("Dauerauftrag", "Standing Order"),
+    ("Lastschrifteinzug", "SEPA Direct Debit"),
+    ("Überweisung", "Bank Transfer"),
+)
+
+def _statement_date(df):
+    """Latest booking date (yyyy-mm-dd) of a statement, used to date its closing balance."""
+    if "Booking Date" not in df.columns or not len(df):
+        return None
+    dates = df["Booking Date"].astype(str).str[:10]
+    dates = dates[dates.str.match(r"^\d{4}-\d{2}-\d{2}$")]
+    return dates.max() if len(dates) else None
+
+def _parse_german_amount(amt_str):
+    return float(amt_str.replace('.', '').replace(',', '.'))
 
 # ===== DKB Extractor Function =====
 
-def extract_dkb_kontoauszug(pdf_path):
-    def detect_reference_account(lines):
-        for line in lines[:50]:
-            line_nospace = re.sub(r"\s+", "", line)
-            m = re.search(r'(DE\d{20})', line_nospace)
-            if m:
-                print(f"[DEBUG] Detected Reference Account (no spaces): {m.group(1)}")
-                return m.group(1)
-        header = re.sub(r"\s+", "", "\n".join(lines[:50]))
-        m = re.search(r'(DE\d{20})', header)
+def _detect_dkb_reference_account(header_nospace):
+    """Find the own IBAN in the whitespace-free first 50 lines of a DKB statement."""
+    for line_nospace in header_nospace:
+        m = _IBAN_DE.search(line_nospace)
         if m:
-            print(f"[DEBUG] Detected Reference Account in header: {m.group(1)}")
-            return m.group(1)
-        print("[DEBUG] No Reference Account IBAN found!")
-        return "Unknown"
-
-    def find_ibans(text, own_iban=None):
-        text_nospace = re.sub(r"\s+", "", text)
-        all_ibans = re.findall(r'DE\d{20}', text_nospace)
-        ibans = [iban for iban in all_ibans if own_iban is None or iban != own_iban]
-        return ibans
-
-    def extract_payee_and_iban(block_text, amount, own_iban=None):
-        amt_regex = r'[-+]?\d{1,3}(?:\.\d{3})*,\d{2}'
-        amt_match = re.search(amt_regex, block_text)
-        payee = ""
-        if amt_match:
-            end = amt_match.end()
-            after_amt = block_text[end:].strip()
-            stop_words = ['Kd.', 'Kunden', 'RG-N', 'Rechnung', 'Gläubiger-ID:', 'KM-', 'EUR', 'r.F', 'IBAN']
-            after_amt_words = after_amt.split()
-            payee_words = []
-            for word in after_amt_words:
-                if any(word.startswith(stop) for stop in stop_words):
-                    break
-                if re.match(r'\d{5,}', word):
-                    break
-                payee_words.append(word)
-            payee = " ".join(payee_words).strip()
-            if not payee:
-                for word in after_amt_words:
-                    if not any(word.startswith(stop) for stop in stop_words):
-                        payee = word
-                        break
-        ibans = find_ibans(block_text, own_iban)
-        counterparty_iban = ibans[-1] if ibans else ""
-        print(f"[DEBUG] In block: {block_text[:70]}... Payee: '{payee}' | IBANs found: {ibans}")
-        return payee, counterparty_iban
-
-    def extract_amount_from_first_line(line):
-        matches = list(re.finditer(r'-?\d{1,3}(?:\.\d{3})*,\d{2}', line))
-        if matches:
-            amt_str = matches[-1].group(0)
-            amt_str = amt_str.replace('.', '').replace(',', '.')
-            return float(amt_str)
-        return 0.0
-
-    with pdfplumber.open(pdf_path) as pdf:
-        lines = []
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                lines.extend(text.split('\n'))
-
-    reference_account = detect_reference_account(lines)
+            _debug(f"[DEBUG] Detected Reference Account (no spaces): {m.group(0)}")
+            return m.group(0)
+    m = _IBAN_DE.search("".join(header_nospace))
+    if m:
+        _debug(f"[DEBUG] Detected Reference Account in header: {m.group(0)}")
+        return m.group(0)
+    _debug("[DEBUG] No Reference Account IBAN found!")
+    return "Unknown"
+
+def _dkb_payee(block_text):
+    amt_match = _DKB_AMOUNT.search(block_text)
+    if not amt_match:
+        return ""
+    after_amt_words = block_text[amt_match.end():].strip().split()
+    payee_words = []
+    for word in after_amt_words:
+        if word.startswith(_DKB_STOP_WORDS) or _DKB_REFERENCE_NUMBER.match(word):
+            break
+        payee_words.append(word)
+    payee = " ".join(payee_words).strip()
+    if not payee:
+        for word in after_amt_words:
+            if not word.startswith(_DKB_STOP_WORDS):
+                return word
+    return payee
+
+def _dkb_transaction(idx, line0, parts, parts_nospace, reference_account, reference_account_name):
+    booking_date = datetime.strptime(_DKB_TX_DATE.match(line0).group(1), "%d.%m.%Y").strftime("%Y-%m-%d")
+    amounts = _DKB_LINE_AMOUNT.findall(line0)
+    amount = _parse_german_amount(amounts[-1]) if amounts else 0.0
+    block_text = " ".join(parts)
+    payee = _dkb_payee(block_text)
+    ibans = [iban for iban in _IBAN_DE.findall("".join(parts_nospace)) if iban != reference_account]
+    counterparty_iban = ibans[-1] if ibans else ""
+    _debug(f"[DEBUG] In block: {block_text[:70]}... Payee: '{payee}' | IBANs found: {ibans}")
+    expl_lower = block_text.lower()
+    tx_type = "Other"
+    for keywords, keyword_type in _DKB_TX_TYPES:
+        if any(k in expl_lower for k in keywords):
+            tx_type = keyword_type
+            break
+    analyzed_amount = "Income" if amount > 0 else "Expenses"
+    return {
+        "idx": idx,
+        "Booking Date": booking_date + " 00:00:00",
+        "Reference Account": reference_account,
+        "Reference Account Name": reference_account_name,
+        "Amount (€)": amount,
+        "Balance (€)": None,
+        "Currency": "EUR",
+        "Payee": payee,
+        "IBAN": counterparty_iban,
+        "Purpose": block_text,
+        "E-Reference": None,
+        "Mandate Reference": "",
+        "Creditor ID": "",
+        "Main Category": "",
+        "Subcategory": "",
+        "Contract": False,
+        "Contract Frequency": "Unknown",
+        "Contract ID": "",
+        "Internal Transfer": "No",
+        "Excluded from Disposable Income": False,
+        "Transaction Type": tx_type,
+        "Analyzed Amount": analyzed_amount,
+        "Tags": "",
+        "Note": "",
+        "text": block_text,
+        "payer": payee if amount > 0 else "",
+        "needs_manual_input": False
+    }
+
+def iter_dkb_transactions(lines, info):
+    """Yield DKB transactions in a single pass over the statement lines.
+
+    A block starts at a line beginning with a date and runs until the next one.
+    Blocks are only turned into transactions once the reference account is
+    known (after the first 50 lines). info collects "reference_account" and the
+    last "Kontostand am" line.
+    """
     reference_account_name = "MY DKB"
+    header_nospace = []
+    reference_account = None
+    waiting = []  # blocks closed before the reference account was known
+    block = None  # (line0, parts, parts_nospace)
+    idx = 1
+    info["balance_line"] = None
 
-    balance_found = None
-    for line in reversed(lines):
+    for n, line in enumerate(lines):
+        line_nospace = None
+        if reference_account is None:
+            line_nospace = _WHITESPACE.sub("", line)
+            header_nospace.append(line_nospace)
         if "Kontostand am" in line:
-            m = re.search(r"([\d\.,]+)\s*(EUR)?\s*$", line)
-            if m:
-                balance_str = m.group(1)
-                if ',' in balance_str and '.' in balance_str:
-                    balance_str = balance_str.replace('.', '').replace(',', '.')
-                elif ',' in balance_str:
-                    balance_str = balance_str.replace('.', '').replace(',', '.')
-                else:
-                    balance_str = balance_str.replace(',', '')
-                try:
-                    balance_found = float(balance_str)
-                except Exception:
-                    balance_found = None
-            break
+            info["balance_line"] = line
 
-    tx_date_pattern = re.compile(r"^(\d{2}\.\d{2}\.\d{4})")
-    transactions = []
-    blocks = []
-    block = []
-    for line in lines:
-        if tx_date_pattern.match(line):
+        if _DKB_TX_DATE.match(line):
             if block:
-                blocks.append(block)
-                block = []
-            block = [line]
+                waiting.append(block)
+            rest = line[11:]
+            block = (line, [rest.strip()], [_WHITESPACE.sub("", rest)])
         elif block:
-            block.append(line)
+            block[1].append(line.strip())
+            block[2].append(line_nospace if line_nospace is not None else _WHITESPACE.sub("", line))
+
+        if reference_account is None and n + 1 >= _DKB_HEADER_LINES:
+            reference_account = _detect_dkb_reference_account(header_nospace)
+            info["reference_account"] = reference_account
+        if reference_account is not None:
+            for line0, parts, parts_nospace in waiting:
+                yield _dkb_transaction(idx, line0, parts, parts_nospace, reference_account, reference_account_name)
+                idx += 1
+            waiting = []
+
+    if reference_account is None:
+        reference_account = _detect_dkb_reference_account(header_nospace)
+        info["reference_account"] = reference_account
     if block:
-        blocks.append(block)
-
-    idx = 1
-    for i, block in enumerate(blocks):
-        line0 = block[0]
-        booking_date = datetime.strptime(tx_date_pattern.match(line0).group(1), "%d.%m.%Y").strftime("%Y-%m-%d")
-        amount = extract_amount_from_first_line(line0)
-        explanation_lines = [line0[11:].strip()] + [ln.strip() for ln in block[1:]]
-        block_text = " ".join(explanation_lines)
-        payee, counterparty_iban = extract_payee_and_iban(block_text, amount, own_iban=reference_account)
-        tx_type = "Other"
-        expl_lower = block_text.lower()
-        if "geldautomat" in expl_lower:
-            tx_type = "Cash Withdrawal"
-        elif "dauerauftrag" in expl_lower:
-            tx_type = "Standing Order"
-        elif "überweisung" in expl_lower:
-            tx_type = "Bank Transfer"
-        elif "basislastschrift" in expl_lower or "lastschrift" in expl_lower:
-            tx_type = "SEPA Direct Debit"
-        elif "zins" in expl_lower or "gebühr" in expl_lower or "interest" in expl_lower:
-            tx_type = "Interest/Fee"
-        elif "karte" in expl_lower or "kartenzahlung" in expl_lower or "debitk" in expl_lower:
-            tx_type = "Card Payment"
-        elif "lohn" in expl_lower or "gehalt" in expl_lower or "rente" in expl_lower:
-            tx_type = "Bank Transfer"
-        analyzed_amount = "Income" if amount > 0 else "Expenses"
-        transactions.append({
-            "idx": idx,
-            "Booking Date": booking_date + " 00:00:00",
-            "Reference Account": reference_account,
-            "Reference Account Name": reference_account_name,
-            "Amount (€)": amount,
-            "Balance (€)": None,
-            "Currency": "EUR",
-            "Payee": payee,
-            "IBAN": counterparty_iban,
-            "Purpose": block_text,
-            "E-Reference": None,
-            "Mandate Reference": "",
-            "Creditor ID": "",
-            "Main Category": "",
-            "Subcategory": "",
-            "Contract": False,
-            "Contract Frequency": "Unknown",
-            "Contract ID": "",
-            "Internal Transfer": "No",
-            "Excluded from Disposable Income": False,
-            "Transaction Type": tx_type,
-            "Analyzed Amount": analyzed_amount,
-            "Week": str(datetime.strptime(booking_date, "%Y-%m-%d").isocalendar()[1]),
-            "Month": booking_date[:7],
-            "Quarter": str((int(booking_date[5:7])-1)//3 + 1),
-            "Year": int(booking_date[:4]),
-            "Tags": "",
-            "Note": "",
-            "text": block_text,
-            "payer": payee if amount > 0 else "",
-            "needs_manual_input": False
-        })
+        waiting.append(block)
+    for line0, parts, parts_nospace in waiting:
+        yield _dkb_transaction(idx, line0, parts, parts_nospace, reference_account, reference_account_name)
         idx += 1
 
-    df = pd.DataFrame(transactions)
+def _dkb_balance_date(line):
+    m = _DKB_BALANCE_DATE.search(line or "")
+    try:
+        return datetime.strptime(m.group(1), "%d.%m.%Y").strftime("%Y-%m-%d") if m else None
+    except ValueError:
+        return None
+
+def _parse_dkb_balance(line):
+    if line is None:
+        return None
+    m = _DKB_BALANCE.search(line)
+    if not m:
+        return None
+    balance_str = m.group(1)
+    if ',' in balance_str:
+        balance_str = balance_str.replace('.', '').replace(',', '.')
+    else:
+        balance_str = balance_str.replace(',', '')
+    try:
+        return float(balance_str)
+    except Exception:
+        return None
+
+def extract_dkb_kontoauszug(pdf_path, ledger=None, lines=None):
+    info = {}
+    lines = iter_pdf_lines(pdf_path) if lines is None else lines
+    df = collect_transactions(iter_dkb_transactions(lines, info))
+    reference_account = info["reference_account"]
+    balance_found = _parse_dkb_balance(info["balance_line"])
+
     if balance_found is not None:
         df = df.sort_values("Booking Date")
-        amounts = df["Amount (€)"].values[::-1]
-        running_bal = [balance_found]
-        for a in amounts[:-1]:
-            running_bal.append(running_bal[-1] - a)
-        df["Balance (€)"] = running_bal[::-1]
-    df.to_csv("dkb_kontoauszug_transactions_final.csv", index=False)
-    print(df.head(10))
-    print(f"Extracted {len(df)} transactions and saved as dkb_kontoauszug_transactions_final.csv")
+        # Walk back from the closing balance: each row's balance is the closing
+        # balance minus the amounts booked after it
+        later_amounts = df["Amount (€)"].iloc[::-1].cumsum().shift(fill_value=0).iloc[::-1]
+        df["Balance (€)"] = balance_found - later_amounts
+    _debug(df.head(10))
+    _debug(f"Extracted {len(df)} DKB transactions")
 
     if balance_found is not None:
-        update_balance_for_account(reference_account, balance_found)
+        statement_date = _dkb_balance_date(info["balance_line"]) or _statement_date(df)
+        update_balance_for_account(reference_account, balance_found, statement_date, ledger=ledger, source=os.path.basename(pdf_path))
 
     return df
 
 
+# ===== N26 Extractor Function =====
+
+def iter_n26_transactions(lines, info):
+    """Yield N26 transactions in a single pass over the statement lines.
+
+    The counterparty IBAN is looked for in the 4 lines after a transaction, so
+    transactions are held back until that window has passed. "Reference Account"
+    depends on the whole statement and is left for the caller to fill in as a
+    column;
+    info collects the candidates for it and the closing balance.
+    """
+    info.update(iban_any=None, iban_bic=None, has_owner_line=False, last_iban=None, balance=None)
+    pending = deque()  # [transaction, lines left in its IBAN window]
 
-def extract_n26_statement(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        lines = []
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                lines.extend(text.split('\n'))
-
-    # Your own IBAN for Reference Account (from bottom or header)
-    ref_iban = None
     for line in lines:
-        m = re.search(r'IBAN:\s*(DE\d{2}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{2})', line)
-        if m and ("NTSBDEB1XXX" in line or "PAVATHARINI MUTHUKKUMAR" in lines):
-            ref_iban = m.group(1).replace(" ", "")
-            break
-    if not ref_iban:
-        # Fallback: grab last DE.... IBAN in file
-        for line in reversed(lines):
-            m = re.search(r'(DE\d{2}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{2})', line)
+        labelled = _N26_IBAN_LABEL.search(line) if "IBAN:" in line else None
+        if labelled:
+            iban = labelled.group(1).replace(" ", "")
+            if info["iban_any"] is None:
+                info["iban_any"] = iban
+            if info["iban_bic"] is None and "NTSBDEB1XXX" in line:
+                info["iban_bic"] = iban
+        if line == "PAVATHARINI MUTHUKKUMAR":
+            info["has_owner_line"] = True
+        if "DE" in line:
+            m = _N26_IBAN.search(line)
+            if m:
+                info["last_iban"] = m.group(1).replace(" ", "")
+        if info["balance"] is None and "Kontostand" in line:
+            m = _N26_BALANCE.search(line)
             if m:
-                ref_iban = m.group(1).replace(" ", "")
-                break
-    ref_account_name = "Pavi"
+                info["balance"] = _parse_german_amount(m.group(1))
+
+        # Hand the IBAN to transactions still looking for one, then release
+        # (in order) those whose lookahead window is over
+        for item in pending:
+            if item[1] > 0:
+                if labelled:
+                    item[0]["IBAN"] = iban
+                    item[1] = 0
+                else:
+                    item[1] -= 1
+        while pending and pending[0][1] <= 0:
+            yield pending.popleft()[0]
 
-    transactions = []
-    for i, line in enumerate(lines):
         # Transaction lines look like: 'PAYEE 14.05.2025 +250,00€'
-        m = re.match(r'(.+?)\s+(\d{2}\.\d{2}\.\d{4})\s+([+-]?\d{1,3}(?:\.\d{3})*,\d{2})€', line)
+        m = _N26_TX.match(line) if "€" in line else None
         if m:
             payee, date, amt_str = m.groups()
-            amount = float(amt_str.replace('.', '').replace(',', '.'))
-            # Look ahead for IBAN (usually next 3 lines)
-            counterparty_iban = ''
-            for j in range(i+1, min(i+5, len(lines))):
-                m2 = re.search(r'IBAN:\s*(DE\d{2}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{4}\s?\d{2})', lines[j])
-                if m2:
-                    counterparty_iban = m2.group(1).replace(" ", "")
-                    break
-            transactions.append({
+            tx = {
                 "Booking Date": datetime.strptime(date, "%d.%m.%Y").strftime("%Y-%m-%d") + " 00:00:00",
-                "Reference Account": ref_iban,
-                "Reference Account Name": ref_account_name,
-                "Amount (€)": amount,
+                "Reference Account": None,
+                "Reference Account Name": "Pavi",
+                "Amount (€)": _parse_german_amount(amt_str),
                 "Currency": "EUR",
                 "Payee": payee.strip(),
-                "IBAN": counterparty_iban,
-            })
-
-    df = pd.DataFrame(transactions)
-    print(df)
-    balance_found = None
-    for line in lines:
-        m = re.search(r'Dein neuer Kontostand\s*([+-]?\d{1,3}(?:\.\d{3})*,\d{2})€', line)
-        if m:
-            balance_found = float(m.group(1).replace('.', '').replace(',', '.'))
-            break
-
-    df.to_csv("n26_statement_extracted.csv", index=False)
-    print(f"Extracted {len(df)} transactions and saved as n26_statement_extracted.csv")
+                "IBAN": '',
+            }
+            pending.append([tx, _N26_IBAN_LOOKAHEAD])
+
+    for tx, _ in pending:
+        yield tx
+
+def _n26_reference_account(info):
+    # Own IBAN: the first labelled IBAN next to N26's BIC (any labelled IBAN if the
+    # owner's name has a line of its own), else the last IBAN in the file
+    if info["has_owner_line"] and info["iban_any"]:
+        return info["iban_any"]
+    return info["iban_bic"] or info["last_iban"]
+
+def extract_n26_statement(pdf_path, ledger=None, lines=None):
+    info = {}
+    lines = iter_pdf_lines(pdf_path) if lines is None else lines
+    df = collect_transactions(iter_n26_transactions(lines, info))
+    ref_iban = _n26_reference_account(info)
+    if len(df):
+        df["Reference Account"] = ref_iban
+
+    _debug(df)
+    _debug(f"Extracted {len(df)} N26 transactions")
+    balance_found = info["balance"]
 
     # --- Update balance using your function if found ---
     if balance_found is not None and ref_iban:
-        update_balance_for_account(ref_iban, balance_found)
+        update_balance_for_account(ref_iban, balance_found, _statement_date(df), ledger=ledger, source=os.path.basename(pdf_path))
 
     return df
 
 
-def extract_db_statement(pdf_path):
-    from datetime import datetime
+# ===== Deutsche Bank Extractor Function =====
 
-    with pdfplumber.open(pdf_path) as pdf:
-        lines = []
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text:
-                lines.extend(text.split('\n'))
+def _db_transaction(line, clean_line, payee_line):
+    amt_m = _DB_AMOUNT.search(clean_line)
+    amount = float(amt_m.group(1)) if amt_m else 0.0
 
-    # Reference Account IBAN (from header)
-    ref_iban = None
-    for line in lines:
-        m = re.search(r'(DE\d{20})', line.replace(" ", ""))
-        if m:
-            ref_iban = m.group(1)
+    # Get value date (second date group) from original line
+    date_match = _DB_VALUE_DATE.match(line)
+    dd_mm = date_match.group(2) if date_match else ""
+    m_year_payee = _DB_YEAR_PAYEE.match(payee_line)
+    if dd_mm and m_year_payee:
+        year = m_year_payee.group(1)
+        day = dd_mm[:2]
+        month = dd_mm[3:5]
+        try:
+            # Always output as yyyy-mm-dd 00:00:00
+            booking_date = datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d 00:00:00")
+        except Exception as e:
+            print(f"[WARNING] Invalid date parts: {year=}, {month=}, {day=}: {e}")
+            booking_date = ""
+        payee = m_year_payee.group(2).strip()
+    else:
+        booking_date = ""
+        payee = payee_line.strip()
+
+    tx_type = "Other"
+    for keyword, keyword_type in _DB_TX_TYPES:
+        if keyword in line:
+            tx_type = keyword_type
             break
-    ref_account_name = "MY DB"
 
-    # --- Extract balance (look for 'EUR +...' pattern at end of file) ---
-    balance_found = None
-    for line in reversed(lines):
-        m = re.match(r'^EUR\s*([+-]?[\d\.,]+)$', line.strip())
-        if m:
-            balance_str = m.group(1).replace(',', '')  # Remove comma as thousands separator only
-
-            try:
-                balance_found = float(balance_str)
-                print(f"[DEBUG] Found balance: {balance_found}")
-                break
-            except:
-                continue
-
-    # --- Transactions extraction ---
-    transactions = []
-    for i in range(len(lines)-1):
-        clean_line = re.sub(r'\s+', '', lines[i])
-        # Only match lines that look like transactions (end with .dd and have SEPA)
-        if re.search(r'\.\d{2}$', clean_line) and "SEPA" in clean_line:
-            amt_m = re.search(r'([+-]?\d+(?:\.\d{3})*\.\d{2})$', clean_line)
-            if not amt_m:
-                amt_m = re.search(r'(\d+(?:\.\d{3})*\.\d{2})$', clean_line)
-            amt_str = amt_m.group(1) if amt_m else ""
-            amount = float(amt_str) if amt_str else 0.0
-
-            # Get value date (second date group) from original line
-            date_match = re.match(r'.*?(\d{2}-\d{2}-)\s*(\d{2}-\d{2}-)', lines[i])
-            dd_mm = date_match.group(2) if date_match else ""
-            payee_line = lines[i+1]
-            m_year_payee = re.match(r'(\d{4})\s+\d{4}\s+(.+)', payee_line)
-            if dd_mm and m_year_payee:
-                year = m_year_payee.group(1)
-                day = dd_mm[:2]
-                month = dd_mm[3:5]
+    return {
+        "Booking Date": booking_date + " 00:00:00",
+        "Reference Account": None,
+        "Reference Account Name": "MY DB",
+        "Amount (€)": amount,
+        "Currency": "EUR",
+        "Payee": payee,
+        "IBAN": "",
+        "Transaction Type": tx_type,
+    }
+
+def _db_transaction_clean_line(line):
+    """Return the whitespace-free line if it looks like a transaction, else None."""
+    # Only lines that end with .dd and have SEPA (once whitespace is removed);
+    # lines not ending in a digit are ruled out without building clean_line
+    tail = line.rstrip()
+    if not tail or not tail[-1].isdigit():
+        return None
+    clean_line = _WHITESPACE.sub('', line)
+    if "SEPA" in clean_line and clean_line[-3:-2] == "." and clean_line[-2:].isdecimal():
+        return clean_line
+    return None
+
+def iter_db_transactions(lines, info):
+    """Yield Deutsche Bank transactions in a single pass over the statement lines.
+
+    A transaction line is followed by its year/payee line; the counterparty IBAN
+    is searched in the 5 lines after that. "Reference Account" (the first IBAN
+    in the file) is left for the caller to fill in; info collects it and the
+    closing balance.
+    """
+    info.update(ref_iban=None, balance=None)
+    tx_line = tx_clean_line = None  # transaction line still waiting for its payee line
+    pending = deque()  # [transaction, lines left in its IBAN window]
+
+    for line in lines:
+        iban = None
+        if pending or info["ref_iban"] is None:
+            m = _IBAN_DE.search(line.replace(" ", ""))
+            iban = m.group(0) if m else None
+            if iban and info["ref_iban"] is None:
+                info["ref_iban"] = iban
+
+        # --- Extract balance (last 'EUR +...' line of the file) ---
+        if "EUR" in line:
+            m = _DB_BALANCE.match(line.strip())
+            if m:
                 try:
-                  # Always output as yyyy-mm-dd 00:00:00
-                  booking_date = f"{year}-{month}-{day} 00:00:00"
-                  # You can also use datetime to double check
-                  booking_date = pd.to_datetime(booking_date, format="%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d 00:00:00")
-                except Exception as e:
-                  print(f"[WARNING] Invalid date parts: {year=}, {month=}, {day=}: {e}")
-                  booking_date = ""
-                payee = m_year_payee.group(2).strip()
-            else:
-                booking_date = ""
-                payee = payee_line.strip()
-
-            # Counterparty IBAN (not your own) in next 5 lines
-            counterparty_iban = ""
-            for j in range(i+2, min(i+7, len(lines))):
-                m_iban = re.search(r'(DE\d{20})', lines[j].replace(" ", ""))
-                if m_iban and m_iban.group(1) != ref_iban:
-                    counterparty_iban = m_iban.group(1)
-                    break
-
-            desc = lines[i]
-            if "Dauerauftrag" in desc:
-                tx_type = "Standing Order"
-            elif "Lastschrifteinzug" in desc:
-                tx_type = "SEPA Direct Debit"
-            elif "Überweisung" in desc:
-                tx_type = "Bank Transfer"
-            else:
-                tx_type = "Other"
-
-            transactions.append({
-                "Booking Date": booking_date + " 00:00:00",
-                "Reference Account": ref_iban,
-                "Reference Account Name": ref_account_name,
-                "Amount (€)": amount,
-                "Currency": "EUR",
-                "Payee": payee,
-                "IBAN": counterparty_iban,
-                "Transaction Type": tx_type,
-            })
+                    info["balance"] = float(m.group(1).replace(',', ''))  # Remove comma as thousands separator only
+                except ValueError:
+                    pass
+
+        # Counterparty IBAN (not your own) for transactions still looking for one
+        for item in pending:
+            if item[1] > 0:
+                if iban and iban != info["ref_iban"]:
+                    item[0]["IBAN"] = iban
+                    item[1] = 0
+                else:
+                    item[1] -= 1
+        while pending and pending[0][1] <= 0:
+            yield pending.popleft()[0]
+
+        if tx_line is not None:
+            pending.append([_db_transaction(tx_line, tx_clean_line, line), _DB_IBAN_LOOKAHEAD])
+        tx_clean_line = _db_transaction_clean_line(line)
+        tx_line = line if tx_clean_line is not None else None
+
+    for tx, _ in pending:
+        yield tx
+
+def extract_db_statement(pdf_path, ledger=None, lines=None):
+    info = {}
+    lines = iter_pdf_lines(pdf_path) if lines is None else lines
+    df = collect_transactions(iter_db_transactions(lines, info))
+    # Reference Account IBAN (from header)
+    ref_iban = info["ref_iban"]
+    if len(df):
+        df["Reference Account"] = ref_iban
+
+    balance_found = info["balance"]
+    if balance_found is not None:
+        _debug(f"[DEBUG] Found balance: {balance_found}")
 
-    df = pd.DataFrame(transactions)
-    print(df)
-    df.to_csv("db_statement_extracted.csv", index=False)
-    print(f"Extracted {len(df)} transactions and saved as db_statement_extracted.csv")
+    _debug(df)
+    _debug(f"Extracted {len(df)} DB transactions")
 
     # --- Save/Update balance if found ---
     if ref_iban and balance_found is not None:
-        update_balance_for_account(ref_iban, balance_found)
+        update_balance_for_account(ref_iban, balance_found, _statement_date(df), ledger=ledger, source=os.path.basename(pdf_path))
 
     return df
-import pandas as pd
 
-def extract_barclays_excel(excel_path):
-    # Read the file as no-header
-    all_data = pd.read_excel(excel_path, header=None)
+_BARCLAYS_META_KEYS = ["IBAN", "Kontoname", "Kontonummer", "Stand", "Verfügungsrahmen"]
+
+def _cell_str(value):
+    return "" if value is None else str(value).strip()
+
+def read_excel_rows(excel_path, max_rows=None):
+    """Yield the first sheet's rows as tuples of cell values, streaming in read-only mode."""
+    wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(max_row=max_rows, values_only=True)
+    finally:
+        wb.close()
+
+def extract_barclays_excel(excel_path, ledger=None):
+    # One streaming pass: metadata block, then the header row, then transactions
+    rows = read_excel_rows(excel_path)
     meta = {}
-    header_row = None
-    for idx, row in all_data.iterrows():
-        key = str(row[0]).strip()
-        value = str(row[1]).strip() if len(row) > 1 else ""
-        if key in ["IBAN", "Kontoname", "Kontonummer", "Stand", "Verfügungsrahmen"]:
-            meta[key] = value
+    header = None
+    for row in rows:
+        key = _cell_str(row[0]) if row else ""
+        if key in _BARCLAYS_META_KEYS:
+            meta[key] = row[1] if len(row) > 1 else ""
         if key == "Referenznummer":
-            header_row = idx
+            header = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(row)]
             break
 
-    if header_row is None:
+    if header is None:
         raise ValueError("Could not find 'Referenznummer' row to detect header.")
 
-    # Read transaction table with proper header
-    df = pd.read_excel(excel_path, header=header_row)
+    # Transaction table from the rows after the header (blank rows skipped)
+    width = len(header)
+    records = [
+        tuple(row[:width]) + (None,) * (width - len(row))
+        for row in rows
+        if any(v is not None and v != "" for v in row)
+    ]
+    rows.close()
+    df = pd.DataFrame.from_records(records, columns=header)
 
     # Balance: "Verfügungsrahmen" or another key, parse to float
-    balance_str = meta.get("Verfügungsrahmen", "").replace(".", "").replace(",", ".")
-    try:
-        latest_balance = float(balance_str)
-    except:
-        latest_balance = None
+    raw_balance = meta.get("Verfügungsrahmen", "")
+    if isinstance(raw_balance, (int, float)):
+        latest_balance = float(raw_balance)
+    else:
+        balance_str = _cell_str(raw_balance).replace(".", "").replace(",", ".")
+        try:
+            latest_balance = float(balance_str)
+        except:
+            latest_balance = None
 
-    # Update balance file if IBAN found
+    meta = {key: _cell_str(value) for key, value in meta.items()}
     iban = meta.get("IBAN", "")
-    if iban and latest_balance is not None:
-        update_balance_for_account(iban, latest_balance)
 
     # Map columns
         # Map columns
@@ -440,7 +666,7 @@ def extract_barclays_excel(excel_path):
             return 0.0
 
     df["Amount (€)"] = df["Betrag"].apply(clean_euro_number)
-    print(df["Betrag"].head(10).to_list())
+    _debug(df["Betrag"].head(10).to_list())
 
     df["Payee"] = df["Beschreibung"]
     df["Currency"] = "EUR"
@@ -455,8 +681,11 @@ def extract_barclays_excel(excel_path):
     ]
     df_final = df[final_cols]
 
-    print(df_final.head())
-    df_final.to_csv("barclays_transactions_final.csv", index=False)
-    print(f"Extracted {len(df_final)} Barclays transactions and saved as barclays_transactions_final.csv")
+    # Update balance file if IBAN found
+    if iban and latest_balance is not None:
+        update_balance_for_account(iban, latest_balance, _statement_date(df_final), ledger=ledger, source=os.path.basename(excel_path))
+
+    _debug(df_final.head())
+    _debug(f"Extracted {len(df_final)} Barclays transactions")
 
     return df_final
\ No newline at end of file
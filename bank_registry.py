@@ -0,0 +1,107 @@
+import os
+
+from bank_extractors import (
+    extract_dkb_kontoauszug,
+    extract_n26_statement,
+    extract_db_statement,
+    extract_barclays_excel,
+    iter_pdf_lines,
+    read_excel_rows,
+)
+
+# ===== Bank registry =====
+# Every bank declares a cheap fingerprint next to its extractor:
+#   - filename_hints: substrings of the lower-cased file name (free to check)
+#   - content_signatures: alternatives, each a tuple of lower-cased strings that
+#     must all appear in the first page(s) of a PDF / the first rows of a workbook
+# detect_bank only reads file content when no file name hint matched, and then
+# only as much as the signatures need. Registration order breaks ties, so
+# adding a bank is one register_bank call and the dispatcher stays untouched.
+
+BANKS = {}
+
+PDF_DETECTION_PAGES = 2  # pages read (one at a time) for content signatures
+EXCEL_DETECTION_ROWS = 10  # rows read for content signatures (first two columns)
+
+def register_bank(name, extractor, file_types, filename_hints=(), content_signatures=()):
+    BANKS[name] = {
+        "name": name,
+        "extractor": extractor,
+        "file_types": tuple(file_types),
+        "filename_hints": tuple(filename_hints),
+        "content_signatures": tuple(tuple(sig) for sig in content_signatures),
+    }
+
+def get_extractor(bank):
+    spec = BANKS.get(bank)
+    return spec["extractor"] if spec else None
+
+def _match_content(candidates, text):
+    for spec in candidates:
+        for signature in spec["content_signatures"]:
+            if all(term in text for term in signature):
+                return spec["name"]
+    return None
+
+def _iter_content_texts(filename, ext):
+    """Yield progressively longer lower-cased text snippets of the file for signature checks."""
+    if ext == ".pdf":
+        for page in range(1, PDF_DETECTION_PAGES + 1):
+            lines = list(iter_pdf_lines(filename, max_pages=page))
+            yield " ".join(lines).lower()
+    else:
+        cells = []
+        for row in read_excel_rows(filename, max_rows=EXCEL_DETECTION_ROWS):
+            cells.extend(str(val) for val in row[:2])
+        yield " ".join(cells).lower()
+
+def detect_bank(filename, lines=None):
+    """Detect bank type from filename and content; lines (if given) are used as the PDF content."""
+    name = os.path.basename(filename).lower()
+    ext = os.path.splitext(name)[1]
+    candidates = [spec for spec in BANKS.values() if ext in spec["file_types"]]
+    if not candidates:
+        return "UNKNOWN"
+
+    # Filename-based detection
+    for spec in candidates:
+        if any(hint in name for hint in spec["filename_hints"]):
+            return spec["name"]
+
+    # Content-based detection
+    candidates = [spec for spec in candidates if spec["content_signatures"]]
+    if not candidates:
+        return "UNKNOWN"
+    if lines is not None:
+        return _match_content(candidates, " ".join(lines).lower()) or "UNKNOWN"
+    try:
+        for text in _iter_content_texts(filename, ext):
+            bank = _match_content(candidates, text)
+            if bank:
+                return bank
+    except Exception as e:
+        print(f"[WARN] Could not read {os.path.basename(filename)} for bank detection ({e})")
+    return "UNKNOWN"
+
+# ===== Built-in banks =====
+
+register_bank(
+    "DKB", extract_dkb_kontoauszug, [".pdf"],
+    filename_hints=["dkb", "kontoauszug"],
+    content_signatures=[["deutsche kreditbank"], ["dkb"]],
+)
+register_bank(
+    "N26", extract_n26_statement, [".pdf"],
+    filename_hints=["n26"],
+    content_signatures=[["iban: de15", "ntsbdeb1xxx"], ["pavatharini muthukkumar", "kontoauszug"]],
+)
+register_bank(
+    "DB", extract_db_statement, [".pdf"],
+    filename_hints=["deutsche", "db", "account_statement"],
+    content_signatures=[["deutsche bank"]],
+)
+register_bank(
+    "BARCLAYS", extract_barclays_excel, [".xlsx"],
+    filename_hints=["barclays"],
+    content_signatures=[["barclays"]],
+)
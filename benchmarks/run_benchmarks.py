@@ -0,0 +1,418 @@
+import os
+import io
+import gc
+import sys
+import re
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import synthetic
+from run_report import peak_rss_mb
+
+# ===== Pipeline benchmarks =====
+# Runs each stage on synthetic statements of a given size and reports rows/sec
+# and peak memory. Every stage runs in a fresh process inside a scratch
+# directory, so its peak RSS is its own; stages a selected stage depends on
+# are run first to produce its input but not reported. Categorization talks
+# to StubModel instead of Gemini, so the numbers measure our own code.
+#
+#   python benchmarks/run_benchmarks.py --rows 1000 100000
+#   python benchmarks/run_benchmarks.py --rows 1000000 --stages clean --json bench.json
+#   python benchmarks/run_benchmarks.py --check-extractors
+
+EXTRACT_STAGES = ("extract_dkb", "extract_n26", "extract_db", "extract_barclays")
+STAGES = EXTRACT_STAGES + ("combine", "clean", "contract_frequency", "categorize")
+DEPENDS = {
+    "combine": EXTRACT_STAGES,
+    "clean": ("combine",),
+    "contract_frequency": ("clean",),
+    "categorize": ("clean",),
+}
+DEFAULT_ROWS = (10_000,)
+
+def _measure(run, rows_in):
+    """Time run() (which returns the number of rows it produced) and record peak memory."""
+    gc.collect()
+    rss_before = peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    rows_out = run()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    rss_after = peak_rss_mb()
+    return {
+        "rows_in": rows_in,
+        "rows_out": rows_out,
+        "seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "rows_per_sec": round(rows_in / wall) if wall > 0 else None,
+        "peak_rss_mb": rss_after,
+        "stage_rss_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+    }
+
+class StubModel:
+    """Stands in for the Gemini model: a fixed category per transaction text, after an optional delay.
+
+    Answers batched prompts too; skip_every=N leaves every Nth item out of a
+    batch answer, so the one-by-one retries get exercised, and fail_every=N
+    fails every Nth call with a 429 like an exhausted quota. Safe to call
+    from several threads.
+    """
+    CATEGORIES = [
+        ("Groceries", "Supermarket"), ("Shopping", "Online Shopping"), ("Housing", "Electricity"),
+        ("Income", "Salary"), ("Dining Out", "Cafe"), ("", ""),
+    ]
+    SINGLE = re.compile(r'Transaction:\n"(.*?)"\n\nInstructions', re.DOTALL)
+    BATCH = re.compile(r'Transactions:\n(.*?)\n\nInstructions', re.DOTALL)
+
+    class Response:
+        def __init__(self, text):
+            self.text = text
+
+    class QuotaExceeded(Exception):
+        code = 429
+
+    def __init__(self, latency=0.0, skip_every=0, fail_every=0):
+        self.latency = latency
+        self.skip_every = skip_every
+        self.fail_every = fail_every
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def categorize(self, text):
+        main_cat, sub_cat = self.CATEGORIES[zlib.crc32(text.encode("utf-8")) % len(self.CATEGORIES)]
+        return {
+            "Main Category": main_cat,
+            "Subcategory": sub_cat,
+            "Contract": sub_cat in ("Electricity", "Salary"),
+            "Contract Frequency": "",
+            "Excluded from Disposable Income": False,
+        }
+
+    def generate_content(self, prompt):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_every and call % self.fail_every == 0:
+            raise self.QuotaExceeded("stub quota exceeded")
+        batch = self.BATCH.search(prompt)
+        if batch is None:
+            single = self.SINGLE.search(prompt)
+            return self.Response(json.dumps(self.categorize(single.group(1) if single else prompt)))
+        answer = []
+        for line in batch.group(1).splitlines():
+            item_id, text = line.split(": ", 1)
+            if self.skip_every and int(item_id) % self.skip_every == 0:
+                continue
+            answer.append({"id": int(item_id), **self.categorize(json.loads(text))})
+        return self.Response(json.dumps(answer))
+
+# ===== Stages =====
+# Each runs in the scratch directory (the pipeline's working directory) and
+# leaves its output there for the stages after it.
+
+def _extract(rows, bank):
+    from bank_extractors import extract_dkb_kontoauszug, extract_n26_statement, extract_db_statement, extract_barclays_excel
+    from balance_ledger import BalanceLedger
+    from process_all_transactions import write_extracted
+    from pipeline_io import EXTRACTED_FOLDER
+    from transaction_schema import apply_schema
+
+    os.makedirs(EXTRACTED_FOLDER, exist_ok=True)
+    ledger = BalanceLedger()
+    if bank == "barclays":
+        path = "synthetic_barclays.xlsx"
+        synthetic.write_barclays_workbook(path, rows)
+        extract = lambda: extract_barclays_excel(path, ledger=ledger)
+    else:
+        extractor, make_lines = {
+            "dkb": (extract_dkb_kontoauszug, synthetic.dkb_lines),
+            "n26": (extract_n26_statement, synthetic.n26_lines),
+            "db": (extract_db_statement, synthetic.db_lines),
+        }[bank]
+        path = f"synthetic_{bank}.pdf"
+        lines = make_lines(rows)
+        extract = lambda: extractor(path, ledger=ledger, lines=lines)
+
+    extracted = {}
+
+    def run():
+        extracted["df"] = df = apply_schema(extract())
+        return len(df)
+    result = _measure(run, rows)
+    write_extracted(extracted["df"], os.path.join(EXTRACTED_FOLDER, f"extracted_{bank.upper()}_synthetic"), ("parquet",))
+    ledger.commit()
+    return result
+
+def _combine(rows, options):
+    from combine_extracted_transactions import combine_transactions
+    from pipeline_io import EXTRACTED_FOLDER, list_tables, read_table
+    rows_in = sum(len(read_table(path)) for path in list_tables(EXTRACTED_FOLDER))
+    return _measure(lambda: len(combine_transactions(incremental=False)), rows_in)
+
+def _clean(rows, options):
+    from clean_transactions import clean_and_harmonize_transactions
+    from pipeline_io import COMBINED_FILE, CLEANED_FILE, read_table
+    rows_in = len(read_table(COMBINED_FILE))
+
+    def run():
+        clean_and_harmonize_transactions(COMBINED_FILE, CLEANED_FILE, chunk_size=options["clean_chunk_size"])
+        return len(read_table(CLEANED_FILE)) if options["clean_chunk_size"] else rows_in
+    result = _measure(run, rows_in)
+    if options["check_chunked"] and options["clean_chunk_size"]:
+        _check_chunked_clean(options["clean_chunk_size"])
+        result["chunked_matches_full"] = True
+    return result
+
+def _check_chunked_clean(chunk_size):
+    """Chunked cleaning must give the same table as cleaning in one go, from Parquet and from CSV input."""
+    from clean_transactions import clean_and_harmonize_transactions
+    from pipeline_io import COMBINED_FILE, read_table
+    read_table(COMBINED_FILE).to_csv("check_combined.csv", index=False)
+    for source in (COMBINED_FILE, "check_combined.csv"):
+        for output in ("check_full.parquet", "check_full.csv"):
+            clean_and_harmonize_transactions(source, output)
+            chunked = output.replace("full", "chunked")
+            clean_and_harmonize_transactions(source, chunked, chunk_size=chunk_size)
+            if not read_table(output).equals(read_table(chunked)):
+                raise AssertionError(f"chunked clean of {source} differs from the full clean ({chunked} vs {output})")
+
+def _contract_frequency(rows, options):
+    from categorize_and_upload import detect_contract_frequency
+    from pipeline_io import CLEANED_FILE, read_table
+    from transaction_schema import without_categories
+    df = without_categories(read_table(CLEANED_FILE))
+    return _measure(lambda: len(detect_contract_frequency(df)), len(df))
+
+def _categorize(rows, options):
+    import categorize_and_upload
+    from pipeline_io import CLEANED_FILE, read_table
+    categorize_and_upload.gemini_model = model = StubModel(
+        options["model_latency"], options["model_skip_every"], options["model_fail_every"])
+    categorize_and_upload.GEMINI_REQUESTS_PER_MINUTE = options["requests_per_minute"]
+    categorize_and_upload.GEMINI_BACKOFF_SECONDS = 0.1  # the stub's 429s need no real cool-down
+    if options["batch_size"]:
+        categorize_and_upload.GEMINI_BATCH_SIZE = options["batch_size"]
+    if options["concurrency"]:
+        categorize_and_upload.GEMINI_MAX_CONCURRENCY = options["concurrency"]
+    df = read_table(CLEANED_FILE)
+    result = _measure(lambda: len(categorize_and_upload.categorize_transactions(df)), len(df))
+    result["model_calls"] = model.calls
+    return result
+
+STAGE_FUNCTIONS = {
+    "extract_dkb": lambda rows, options: _extract(rows, "dkb"),
+    "extract_n26": lambda rows, options: _extract(rows, "n26"),
+    "extract_db": lambda rows, options: _extract(rows, "db"),
+    "extract_barclays": lambda rows, options: _extract(rows, "barclays"),
+    "combine": _combine,
+    "clean": _clean,
+    "contract_frequency": _contract_frequency,
+    "categorize": _categorize,
+}
+
+def run_stage(stage, workdir, rows, options):
+    """Entry point of the per-stage process."""
+    os.chdir(workdir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = STAGE_FUNCTIONS[stage](rows, options)
+    return {"stage": stage, **result}
+
+def _with_dependencies(stages):
+    needed = set()
+    def add(stage):
+        for dep in DEPENDS.get(stage, ()):
+            add(dep)
+        needed.add(stage)
+    for stage in stages:
+        add(stage)
+    return [stage for stage in STAGES if stage in needed]
+
+def run_benchmarks(sizes=DEFAULT_ROWS, stages=STAGES, clean_chunk_size=None, model_latency=0.0, keep=False,
+                   batch_size=None, model_skip_every=0, model_fail_every=0, concurrency=None, requests_per_minute=0,
+                   check_chunked=False):
+    """Benchmark the selected stages for each size (transactions per statement); returns one result dict per stage and size."""
+    options = {
+        "clean_chunk_size": clean_chunk_size,
+        "model_latency": model_latency,
+        "batch_size": batch_size,
+        "model_skip_every": model_skip_every,
+        "model_fail_every": model_fail_every,
+        "concurrency": concurrency,
+        "requests_per_minute": requests_per_minute,
+        "check_chunked": check_chunked,
+    }
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for rows in sizes:
+        workdir = tempfile.mkdtemp(prefix=f"kubera_bench_{rows}_")
+        try:
+            for stage in _with_dependencies(stages):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_stage, stage, workdir, rows, options).result()
+                if stage in stages:
+                    result["rows"] = rows
+                    results.append(result)
+                    print_result(result)
+        finally:
+            if keep:
+                print(f"📁 Benchmark files kept in {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def print_result(result):
+    rate = f"{result['rows_per_sec']:>12,}" if result["rows_per_sec"] is not None else f"{'-':>12}"
+    peak = f"{result['peak_rss_mb']:>9}" if result["peak_rss_mb"] is not None else f"{'-':>9}"
+    print(f"{result['rows']:>9,}  {result['stage']:<20}{result['rows_in']:>10,}{result['seconds']:>10.3f}{rate}{peak}{result['stage_rss_mb'] or 0:>9}")
+
+# ===== Output checks =====
+# Fixed inputs with known outputs for the code that was rewritten for speed:
+# the PDF line extractors, the column-wide date harmonization and the noise
+# cleaning. The extractor output on the synthetic lines is frozen in
+# EXPECTED_EXTRACTORS; after an intended output change, refresh it with
+# --check-extractors --update-expected and bump EXTRACTOR_VERSION.
+
+EXPECTED_EXTRACTORS = os.path.join(BENCHMARK_DIR, "expected_extractors.json")
+# 5 transactions end before the DKB reference account is known (line 50), 120 run past it
+EXTRACTOR_CHECK_ROWS = (5, 120)
+
+DATE_CASES = [
+    ("2024-03-05 12:30:00", "2024-03-05 00:00:00"),
+    ("2024-03-05T08:00:00", "2024-03-05 00:00:00"),
+    ("05.03.2024", "2024-03-05 00:00:00"),
+    ("2024-03-05", "2024-03-05 00:00:00"),
+    ("05/03/2024", "2024-03-05 00:00:00"),
+    ("  05.03.2024 Gutschrift", "2024-03-05 00:00:00"),
+    ("2024-03-05 00:00:00 00:00:00", "2024-03-05 00:00:00"),  # DB booking dates
+    ("", ""),
+    ("   ", ""),
+    (None, ""),
+    (float("nan"), ""),
+    ("31.02.2024", ""),
+    ("29.02.2023", ""),
+    ("01.01.1500", "1500-01-01 00:00:00"),  # out of range for pandas, parsed row by row
+    ("March 5, 2024", "2024-03-05 00:00:00"),
+    ("not a date", ""),
+    (20240305, "1970-01-01 00:00:00"),  # a number is read as nanoseconds, as parse_date does
+    ("05.03.2024", "2024-03-05 00:00:00"),  # repeated value
+]
+
+NOISE_CASES = [
+    ("VISA Debitkartenumsatz REWE Markt", "REWE Markt"),
+    ("Issuer: Amazon EU", ": Amazon EU"),
+    ("12issuer34,56", ""),  # removing "issuer" creates the amount "1234,56"
+    ("Tassilostrasse 12 80939 München Einkauf", "Einkauf"),
+    ("im Heller 3 Lieferung", "Lieferung"),
+    ("Bayenwerft 12 Köln", "Köln"),
+    ("Flughafenstrasse 7", ""),
+    ("Flughafenstraße 7", "Flughafenstraße 7"),
+    ("Scalable Capital Sparplan", "Sparplan"),
+    ("Kartenabrechnung 03/2024", "03/2024"),
+    ("Kundennummer 1234", "1234"),
+    ("Darlehensrate", ""),
+    ("CHECK24 Vergleich", "Vergleich"),
+    ("siehe www.example.com danke", "siehe  danke"),
+    ("Betrag 1.234,56 EUR", "Betrag 1. EUR"),
+    ("  Netflix International  ", "Netflix International"),
+    ("REWE Markt GmbH", "REWE Markt GmbH"),
+    ("", ""),
+    (None, ""),
+    (float("nan"), ""),
+    (42, ""),
+    ("Issuer: Amazon EU", ": Amazon EU"),  # repeated value
+]
+
+def _extractor_outputs():
+    """Columns, dtypes, rows and collected info of each PDF extractor on the synthetic lines."""
+    from bank_extractors import collect_transactions, iter_dkb_transactions, iter_n26_transactions, iter_db_transactions
+    extractors = {
+        "dkb": (iter_dkb_transactions, synthetic.dkb_lines),
+        "n26": (iter_n26_transactions, synthetic.n26_lines),
+        "db": (iter_db_transactions, synthetic.db_lines),
+    }
+    outputs = {}
+    for bank, (iter_transactions, make_lines) in extractors.items():
+        for rows in EXTRACTOR_CHECK_ROWS:
+            info = {}
+            df = collect_transactions(iter_transactions(make_lines(rows), info))
+            outputs[f"{bank}_{rows}"] = {
+                "columns": list(df.columns),
+                "dtypes": df.dtypes.astype(str).tolist(),
+                "rows": df.to_dict("split")["data"],
+                "info": info,
+            }
+    # Through JSON, so fresh and frozen outputs have the same types
+    return json.loads(json.dumps(outputs))
+
+def check_extractors(update_expected=False):
+    """Compare the extractors, harmonize_booking_dates and clean_text_column against known outputs."""
+    import pandas as pd
+    from clean_transactions import harmonize_booking_dates, parse_date
+    from categorize_and_upload import clean_text, clean_text_column
+
+    outputs = _extractor_outputs()
+    if update_expected:
+        with open(EXPECTED_EXTRACTORS, "w", encoding="utf-8") as f:
+            json.dump(outputs, f, indent=1, ensure_ascii=False)
+        print(f"💾 Extractor output frozen in {EXPECTED_EXTRACTORS}")
+    with open(EXPECTED_EXTRACTORS, encoding="utf-8") as f:
+        expected = json.load(f)
+    for name in sorted(set(expected) | set(outputs)):
+        if outputs.get(name) != expected.get(name):
+            raise AssertionError(f"extractor output for {name} differs from {os.path.basename(EXPECTED_EXTRACTORS)}")
+
+    for cases, harmonize, single, label in (
+        (DATE_CASES, harmonize_booking_dates, parse_date, "harmonize_booking_dates"),
+        (NOISE_CASES, clean_text_column, clean_text, "clean_text_column"),
+    ):
+        values = pd.Series([value for value, _ in cases], dtype=object)
+        result = harmonize(values).tolist()
+        for (value, wanted), got in zip(cases, result):
+            if got != wanted or single(value) != wanted:
+                raise AssertionError(f"{label}({value!r}) gave {got!r}, row by row {single(value)!r}, expected {wanted!r}")
+    print(f"✅ Extractors ({len(outputs)} statements), {len(DATE_CASES)} date cases and {len(NOISE_CASES)} noise cases match")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic statements.")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(DEFAULT_ROWS), help="transactions per statement (one run per size)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--clean-chunk-size", type=int, default=None, help="benchmark the streaming clean mode")
+    parser.add_argument("--check-chunked", action="store_true", help="also check that the streaming clean gives the same table as a full clean")
+    parser.add_argument("--check-extractors", action="store_true", help="check the extractors, date harmonization and text cleaning against known outputs instead of benchmarking")
+    parser.add_argument("--update-expected", action="store_true", help="with --check-extractors: freeze the current extractor output first")
+    parser.add_argument("--model-latency", type=float, default=0.0, help="seconds the stub model waits per call")
+    parser.add_argument("--batch-size", type=int, default=None, help="transactions per categorization prompt (default: GEMINI_BATCH_SIZE)")
+    parser.add_argument("--model-skip-every", type=int, default=0, help="the stub model leaves every Nth item out of batch answers")
+    parser.add_argument("--model-fail-every", type=int, default=0, help="the stub model answers every Nth call with a 429 error")
+    parser.add_argument("--concurrency", type=int, default=None, help="requests in flight at once (default: GEMINI_MAX_CONCURRENCY)")
+    parser.add_argument("--rpm", type=float, default=0, help="requests per minute for the rate limiter (default: no limit)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    args = parser.parse_args(argv)
+    if args.check_extractors:
+        check_extractors(args.update_expected)
+        return
+
+    print(f"{'size':>9}  {'stage':<20}{'rows in':>10}{'seconds':>10}{'rows/sec':>12}{'peak MB':>9}{'+MB':>9}")
+    results = run_benchmarks(args.rows, tuple(args.stages), args.clean_chunk_size, args.model_latency, args.keep,
+                             args.batch_size, args.model_skip_every, args.model_fail_every, args.concurrency, args.rpm,
+                             args.check_chunked)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+        print(f"💾 Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
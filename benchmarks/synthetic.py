@@ -0,0 +1,93 @@
+import random
+from datetime import date, timedelta
+
+import openpyxl
+
+# ===== Synthetic statements =====
+# Text lines as pdfplumber gives them for DKB, N26 and Deutsche Bank
+# statements, and a Barclays-style Excel export, with any number of
+# transactions. Bookings are spread evenly over FIRST_DAY .. FIRST_DAY + SPAN_DAYS
+# so even a million rows keep realistic dates; a fixed seed makes every run
+# produce the same data.
+
+FIRST_DAY = date(2015, 1, 1)
+SPAN_DAYS = 3650
+
+DKB_IBAN = "DE12 1203 0000 1234 5678 90"
+N26_IBAN = "DE15 1001 1001 2623 4567 89"
+DB_IBAN = "DE89 3704 0044 0532 0130 00"
+BARCLAYS_IBAN = "DE55 2003 0000 1234 5678 90"
+
+PAYEES = [
+    "REWE Markt GmbH", "Amazon EU", "Stadtwerke Berlin", "Lohn Firma XY", "Kartenzahlung Lidl",
+    "Geldautomat Sparkasse", "Netflix International", "Shell Station 42", "DM Drogerie Markt",
+    "Vodafone GmbH", "Deutsche Bahn", "Allianz Versicherung",
+]
+
+def _booking_day(i, n):
+    return FIRST_DAY + timedelta(days=i * SPAN_DAYS // max(n, 1))
+
+def german_amount(amount):
+    """1234.5 -> '1.234,50' (sign kept)."""
+    text = f"{abs(amount):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return ("-" if amount < 0 else "") + text
+
+def _iban(r, bank_code):
+    return f"DE{r.randint(10, 99)} {bank_code} {r.randint(1000, 9999)} {r.randint(1000, 9999)} {r.randint(10, 99)}"
+
+def dkb_lines(n, seed=1):
+    r = random.Random(seed)
+    kinds = ["Basislastschrift", "Überweisung", "Dauerauftrag", "Kartenzahlung", "Gehalt", "Zinsen"]
+    lines = ["Deutsche Kreditbank AG", "Kontoauszug 1/2024", f"IBAN {DKB_IBAN}", "Kontostand am 01.01.2015 1.000,00 EUR"]
+    for i in range(n):
+        day = _booking_day(i, n)
+        amount = round(r.uniform(-500, 300), 2)
+        lines.append(f"{day:%d.%m.%Y} {kinds[i % len(kinds)]} {german_amount(amount)} {PAYEES[i % len(PAYEES)]} Kd.Nr 1234567")
+        lines.append(f"IBAN {_iban(r, '1001 0010')}")
+        if i % 3 == 0:
+            lines.append("Verwendungszweck RG-Nr 55555 EUR")
+    lines.append(f"Kontostand am {_booking_day(n, n):%d.%m.%Y} 1.234,56 EUR")
+    return lines
+
+def n26_lines(n, seed=2):
+    r = random.Random(seed)
+    lines = ["Kontoauszug", "PAVATHARINI MUTHUKKUMAR", f"IBAN: {N26_IBAN} NTSBDEB1XXX"]
+    for i in range(n):
+        day = _booking_day(i, n)
+        amount = round(r.uniform(-300, 300), 2)
+        lines.append(f"{PAYEES[i % len(PAYEES)]} {day:%d.%m.%Y} {'+' if amount > 0 else ''}{german_amount(amount)}€")
+        if i % 2 == 0:
+            lines.append(f"IBAN: {_iban(r, '1001 1001')}")
+        lines.append("Lastschrift")
+    lines.append("Dein neuer Kontostand +1.234,56€")
+    return lines
+
+def db_lines(n, seed=3):
+    r = random.Random(seed)
+    kinds = ["SEPA Lastschrifteinzug", "SEPA Überweisung", "SEPA Dauerauftrag"]
+    lines = ["Deutsche Bank", f"IBAN {DB_IBAN}"]
+    for i in range(n):
+        day = _booking_day(i, n)
+        amount = round(r.uniform(-300, 300), 2)
+        lines.append(f"{day:%d-%m-} {day:%d-%m-} {kinds[i % len(kinds)]} {'+' if amount > 0 else '-'} {abs(amount):,.2f}")
+        lines.append(f"{day:%Y} {day:%Y} {PAYEES[i % len(PAYEES)]}")
+        lines.append(f"IBAN {_iban(r, '5001 0517')}")
+    lines.append("EUR +1,234.56")
+    return lines
+
+def write_barclays_workbook(path, n, seed=4):
+    """Barclays export: metadata block, header row, then one row per transaction."""
+    r = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(["Barclays Visa", None])
+    ws.append(["IBAN", BARCLAYS_IBAN])
+    ws.append(["Kontoname", "Barclays Visa"])
+    ws.append(["Verfügungsrahmen", "2.500,00"])
+    ws.append([None, None])
+    ws.append(["Referenznummer", "Buchungsdatum", "Valutadatum", "Betrag", "Beschreibung"])
+    for i in range(n):
+        day = _booking_day(i, n).strftime("%d.%m.%Y")
+        amount = round(r.uniform(-300, 300), 2)
+        ws.append([f"REF{i}", day, day, german_amount(amount) + " €", PAYEES[i % len(PAYEES)]])
+    wb.save(path)
@@ -1,11 +1,18 @@
 import os
 import re
 import json
-import time
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
+from pipeline_io import CLEANED_FILE, CATEGORIZED_FILE, read_table, write_table
+from transaction_schema import apply_schema, without_categories
+from rate_limiter import TokenBucket, call_with_backoff
+from category_cache import CategoryCache
+
 # ==== Load secrets from .env file ====
 load_dotenv()
 
@@ -13,18 +20,29 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
-assert SUPABASE_URL, "Missing SUPABASE_URL in .env"
-assert SUPABASE_KEY, "Missing SUPABASE_KEY in .env"
-assert GEMINI_API_KEY, "Missing GEMINI_API_KEY in .env"
-
-# ==== Set up Supabase ====
-from supabase import create_client, Client
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# ==== Set up Gemini ====
-import google.generativeai as genai
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel(model_name="models/gemini-1.5-flash")
+# ==== Clients ====
+# Created on first use, so the module can be imported (e.g. by the benchmarks,
+# which set gemini_model to a stub) without credentials.
+supabase = None
+gemini_model = None
+
+def get_supabase():
+    global supabase
+    if supabase is None:
+        assert SUPABASE_URL, "Missing SUPABASE_URL in .env"
+        assert SUPABASE_KEY, "Missing SUPABASE_KEY in .env"
+        from supabase import create_client
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase
+
+def get_gemini_model():
+    global gemini_model
+    if gemini_model is None:
+        assert GEMINI_API_KEY, "Missing GEMINI_API_KEY in .env"
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        gemini_model = genai.GenerativeModel(model_name="models/gemini-1.5-flash")
+    return gemini_model
 
 # ==== Patterns for cleaning ====
 own_name_patterns = [
@@ -49,19 +67,43 @@ noise_patterns = [
     r'(?i)www\.\S+',
     r'(?i)\d{3,}[.,]\d{2}',  # monetary values
 ]
+
+def _scoped(pattern):
+    # "(?i)x" -> "(?i:x)": global flags are only allowed at the start of a regex
+    return f"(?i:{pattern[4:]})" if pattern.startswith('(?i)') else f"(?:{pattern})"
+
+NOISE_REGEXES = [re.compile(pattern) for pattern in noise_patterns]
+# Matches wherever any noise pattern does. Texts it does not match are left
+# as they are; the others still go through NOISE_REGEXES one by one and in
+# order, because removing one match can create the next (e.g. "12issuer34,56").
+NOISE_DETECTOR = re.compile("|".join(_scoped(pattern) for pattern in noise_patterns))
+
 def clean_text(text, remove_names=True):
     if not isinstance(text, str):
         return ""
     #patterns = noise_patterns + (own_name_patterns if remove_names else [])
-    patterns = noise_patterns 
-    for pattern in patterns:
-        text = re.sub(pattern, '', text)
+    if NOISE_DETECTOR.search(text):
+        for regex in NOISE_REGEXES:
+            text = regex.sub('', text)
     return text.strip()
 
-# ==== Gemini cache system ====
-MEMORY_FILE = 'gemini_memory.json'
-REQUIRED_DELAY_SECONDS = 4.0
+def clean_text_column(values):
+    """clean_text for a whole column: each distinct value is cleaned once, with vectorized string operations."""
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    noisy = uniques.str.contains(NOISE_DETECTOR, na=False)
+    if noisy.any():
+        cleaned = uniques[noisy]
+        for regex in NOISE_REGEXES:
+            cleaned = cleaned.str.replace(regex, '', regex=True)
+        uniques[noisy] = cleaned
+    # Non-text values become "", like clean_text; the appended "" is what the
+    # code -1 of missing values picks
+    cleaned = np.append(uniques.str.strip().fillna('').to_numpy(dtype=object), '')
+    return pd.Series(cleaned.take(codes), index=values.index)
 
+# ==== Gemini cache system ====
+# Answers are stored per cache key in category_cache.CategoryCache
 def normalize_text(text):
     """Normalize text for consistent cache key generation"""
     if not text:
@@ -74,47 +116,22 @@ def create_cache_key(text):
         return hashlib.md5(normalized.encode('utf-8')).hexdigest()
     return normalized
 
-def load_memory():
-    if os.path.exists(MEMORY_FILE):
-        try:
-            with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
-                memory = json.load(f)
-                print(f"✅ Loaded {len(memory)} entries from cache file")
-                return memory
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            print(f"⚠️ Error loading cache file: {e}. Starting with empty cache.")
-            return {}
-    else:
-        print("📝 No existing cache file found. Starting with empty cache.")
-        return {}
-
-def save_memory(memory):
-    try:
-        if os.path.exists(MEMORY_FILE):
-            backup_file = f"{MEMORY_FILE}.backup"
-            os.rename(MEMORY_FILE, backup_file)
-        with open(MEMORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(memory, f, indent=2, ensure_ascii=False)
-        backup_file = f"{MEMORY_FILE}.backup"
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
-        print(f"💾 Saved {len(memory)} entries to cache file")
-    except Exception as e:
-        print(f"❌ Error saving cache file: {e}")
-        backup_file = f"{MEMORY_FILE}.backup"
-        if os.path.exists(backup_file):
-            os.rename(backup_file, MEMORY_FILE)
-            print("🔄 Restored backup cache file")
-
 # ==== Gemini API wrapper ====
-def ask_gemini_for_category(text):
-    prompt = f"""
-You are a smart finance assistant. Based on the transaction text below, determine the most appropriate **Main Category and Subcategory combination**.
-
-Transaction:
-"{text}"
-
-Instructions:
+# Transactions are sent GEMINI_BATCH_SIZE at a time in one prompt, so the
+# category rules are sent once per batch instead of once per transaction.
+# 1 sends every transaction in a prompt of its own.
+GEMINI_BATCH_SIZE = 20
+# Up to GEMINI_MAX_CONCURRENCY requests are in flight at once, started at no
+# more than GEMINI_REQUESTS_PER_MINUTE (0: no limit) with bursts of up to
+# GEMINI_BURST. Rate limiting (429) and server errors (5xx) are retried up to
+# GEMINI_MAX_RETRIES times, waiting GEMINI_BACKOFF_SECONDS, then twice as long, ...
+GEMINI_REQUESTS_PER_MINUTE = 15
+GEMINI_BURST = 1
+GEMINI_MAX_CONCURRENCY = 4
+GEMINI_MAX_RETRIES = 5
+GEMINI_BACKOFF_SECONDS = 2.0
+
+PROMPT_RULES = """Instructions:
 
 1. Match the transaction to **one and only one** of the following **Main Category → Subcategory** combinations. Evaluate them **jointly** and not independently. The match must be based on **overall meaning**, including merchant name, purpose, and any recognizable patterns.
 
@@ -149,7 +166,47 @@ Instructions:
    - "Subcategory": ""
 
 Do not invent or guess new categories.
+"""
+
+EMPTY_RESULT = {
+    "Main Category": "",
+    "Subcategory": "",
+    "Contract": False,
+    "Contract Frequency": "",
+    "Excluded from Disposable Income": False
+}
+
+rate_limiter = None
+gemini_requests = 0
+_requests_lock = threading.Lock()
+
+def get_rate_limiter():
+    global rate_limiter
+    # Called from the worker threads: the lock makes sure they all share one bucket
+    with _requests_lock:
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60, GEMINI_BURST)
+        return rate_limiter
+
+def _generate(prompt):
+    """Send one prompt to Gemini within the rate limit, retrying 429/5xx errors; returns the answer text."""
+    def attempt():
+        global gemini_requests
+        get_rate_limiter().acquire()
+        with _requests_lock:
+            gemini_requests += 1
+        return get_gemini_model().generate_content(prompt).text.strip()
+    return call_with_backoff(attempt, GEMINI_MAX_RETRIES, GEMINI_BACKOFF_SECONDS)
+
+def ask_gemini_for_category(text):
+    """Categorize one text; returns its result, or None if Gemini gave no usable answer."""
+    prompt = f"""
+You are a smart finance assistant. Based on the transaction text below, determine the most appropriate **Main Category and Subcategory combination**.
+
+Transaction:
+"{text}"
 
+{PROMPT_RULES}
 Respond strictly in this JSON format:
 {{
   "Main Category": "...",
@@ -160,21 +217,89 @@ Respond strictly in this JSON format:
 }}
 """
     try:
-        response = gemini_model.generate_content(prompt)
-        raw = response.text.strip()
+        raw = _generate(prompt)
         json_text = re.search(r"\{.*\}", raw, re.DOTALL)
         if json_text:
             result = json.loads(json_text.group())
             return result
     except Exception as e:
         print(f"⚠️ Gemini API Error: {e}")
-    return {
-        "Main Category": "",
-        "Subcategory": "",
-        "Contract": False,
-        "Contract Frequency": "",
-        "Excluded from Disposable Income": False
-    }
+    return None
+
+def batch_prompt(texts):
+    # json.dumps keeps every transaction on one line, quotes escaped
+    transactions = "\n".join(f"{i}: {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(texts, 1))
+    return f"""
+You are a smart finance assistant. For each transaction text below (ID: "text"), determine the most appropriate **Main Category and Subcategory combination**.
+
+Transactions:
+{transactions}
+
+{PROMPT_RULES}
+Categorize every transaction on its own. Respond strictly with a JSON array holding one object per transaction, in this format:
+[
+  {{
+    "id": <transaction ID>,
+    "Main Category": "...",
+    "Subcategory": "...",
+    "Contract": true or false,
+    "Contract Frequency": "...",
+    "Excluded from Disposable Income": true or false
+  }}
+]
+"""
+
+def parse_batch_response(raw, count):
+    """{id: result} for the well-formed items of a batched answer about count transactions."""
+    items = None
+    array_text = re.search(r"\[.*\]", raw, re.DOTALL)
+    if array_text:
+        try:
+            items = json.loads(array_text.group())
+        except json.JSONDecodeError:
+            pass
+    if not isinstance(items, list):
+        # e.g. a truncated answer: keep the objects that are complete
+        items = []
+        for object_text in re.findall(r"\{[^{}]*\}", raw):
+            try:
+                items.append(json.loads(object_text))
+            except json.JSONDecodeError:
+                pass
+
+    answers = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        result = dict(item)
+        try:
+            item_id = int(result.pop("id"))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not isinstance(result.get("Main Category"), str) or not isinstance(result.get("Subcategory"), str):
+            continue
+        if 1 <= item_id <= count and item_id not in answers:
+            answers[item_id] = result
+    return answers
+
+def ask_gemini_for_categories(texts):
+    """Categorize several texts with one prompt; returns one result per text, None where it failed.
+
+    Texts missing from the answer, or with a malformed item, are asked again
+    one by one. If the request itself fails (after its retries), asking one by
+    one would only hit the same error, so the whole batch is None.
+    """
+    if len(texts) == 1:
+        return [ask_gemini_for_category(texts[0])]
+    try:
+        answers = parse_batch_response(_generate(batch_prompt(texts)), len(texts))
+    except Exception as e:
+        print(f"⚠️ Gemini API Error: {e}")
+        return [None] * len(texts)
+    missing = len(texts) - len(answers)
+    if missing:
+        print(f"🔁 {missing} of {len(texts)} transactions missing from the batch answer, asking one by one")
+    return [answers[i] if i in answers else ask_gemini_for_category(text) for i, text in enumerate(texts, 1)]
 
 # ==== Contract frequency detection ====
 def detect_contract_frequency(df: pd.DataFrame) -> pd.DataFrame:
@@ -198,67 +323,79 @@ def detect_contract_frequency(df: pd.DataFrame) -> pd.DataFrame:
         df.loc[group.index, 'Contract Frequency'] = freq
     return df
 
-# ==== MAIN FUNCTION ====
-def main():
-    # === Load cleaned transactions ===
-    input_csv = "all_bank_transactions_cleaned.csv"
-    output_csv = "categorized_transactions.csv"
-    df = pd.read_csv(input_csv)
+# ==== Categorization ====
+def categorize_transactions(df):
+    """Categorize the cleaned transactions in df; returns the categorized frame."""
+    get_gemini_model()  # fail fast on missing credentials
+    # Categories are set row by row below, so work on plain object columns
+    df = without_categories(df)
 
     # ==== Clean and recompute 'text' column ====
-    df['Payee'] = df['Payee'].apply(lambda x: clean_text(x, remove_names=False))
-    df['Purpose'] = df['Purpose'].apply(lambda x: clean_text(x, remove_names=True))
+    df['Payee'] = clean_text_column(df['Payee'])
+    df['Purpose'] = clean_text_column(df['Purpose'])
     df['text'] = (df['Payee'].fillna('') + ' ' + df['Purpose'].fillna('')).str.strip()
-    df['text'] = df['text'].apply(lambda x: clean_text(x, remove_names=False))
-
-    # ==== Load memory cache ====
-    gemini_memory = load_memory()
+    # Joining Payee and Purpose can form new matches, so clean once more
+    df['text'] = clean_text_column(df['text'])
 
     # ==== Enrichment ====
     print(f"\n🚀 Starting enrichment for {len(df)} transactions")
-    print(f"📊 Memory cache contains {len(gemini_memory)} entries")
 
     df['Contract'] = False
     df['Contract Frequency'] = ""
     df['Excluded from Disposable Income'] = False
     df['needs_manual_input'] = False
 
-    cache_hits = 0
-    api_calls = 0
-    last_gemini_call_time = time.monotonic()
-
-    for idx, row in df.iterrows():
-      text = row['text'] if 'text' in row else str(row.get('description', ''))
-      if not text or text.strip() == '':
-        continue
-      cache_key = create_cache_key(text)
-      if cache_key in gemini_memory:
-        result = gemini_memory[cache_key]
-        cache_hits += 1
-      else:
-        current_time = time.monotonic()
-        time_since_last_call = current_time - last_gemini_call_time
-        if time_since_last_call < REQUIRED_DELAY_SECONDS:
-            time.sleep(REQUIRED_DELAY_SECONDS - time_since_last_call)
-        last_gemini_call_time = time.monotonic()
-        result = ask_gemini_for_category(text)
-        gemini_memory[cache_key] = result
-        api_calls += 1
-      main_cat = result.get("Main Category", "")
-      sub_cat = result.get("Subcategory", "")
-      df.at[idx, 'Main Category'] = main_cat
-      df.at[idx, 'Subcategory'] = sub_cat
-      df.at[idx, 'Contract'] = result.get("Contract", False)
-      df.at[idx, 'Contract Frequency'] = ""  # Will fill after
-      df.at[idx, 'Excluded from Disposable Income'] = result.get("Excluded from Disposable Income", False)
-      # Updated logic for needs_manual_input:
-      df.at[idx, 'needs_manual_input'] = (not main_cat or not sub_cat)
-
-    # Save updated cache
-    if api_calls > 0:
-        save_memory(gemini_memory)
-
-    print(f"\n📈 Summary: {len(df)} processed, {cache_hits} cache hits, {api_calls} API calls.")
+    # Each distinct text is resolved once, from the cache or from Gemini, and
+    # the results are written back to all rows with that text as whole columns
+    has_text = df['text'].str.strip() != ''
+    codes, texts = pd.factorize(df.loc[has_text, 'text'])
+    cache_keys = [create_cache_key(text) for text in texts]
+
+    with CategoryCache() as cache:
+        known = cache.get_many(cache_keys)
+        # Texts not in the cache yet, in order of first occurrence
+        uncached = {}
+        for cache_key, text in zip(cache_keys, texts):
+            if cache_key not in known and cache_key not in uncached:
+                uncached[cache_key] = text
+        requests_before = gemini_requests
+        failed = 0
+        batch_size = max(1, GEMINI_BATCH_SIZE)
+        uncached_keys = list(uncached)
+        batches = [uncached_keys[start:start + batch_size] for start in range(0, len(uncached_keys), batch_size)]
+        pool = ThreadPoolExecutor(max_workers=max(1, GEMINI_MAX_CONCURRENCY))
+        try:
+            futures = {pool.submit(ask_gemini_for_categories, [uncached[key] for key in batch]): batch for batch in batches}
+            # Stored as each batch arrives, whatever order they finish in
+            # Failed texts (None) are not stored, so the next run asks again
+            for future in as_completed(futures):
+                answers = {key: result for key, result in zip(futures[future], future.result()) if result is not None}
+                failed += len(futures[future]) - len(answers)
+                cache.put_many(answers)
+                known.update(answers)
+        finally:
+            # On Ctrl-C or an error, don't start the batches still queued
+            pool.shutdown(cancel_futures=True)
+        api_calls = gemini_requests - requests_before
+    cache_hits = int(has_text.sum()) - len(uncached)
+
+    results = [known.get(cache_key, EMPTY_RESULT) for cache_key in cache_keys]
+    resolved = pd.DataFrame({
+        'Main Category': [result.get("Main Category", "") for result in results],
+        'Subcategory': [result.get("Subcategory", "") for result in results],
+        'Contract': [result.get("Contract", False) for result in results],
+        'Excluded from Disposable Income': [result.get("Excluded from Disposable Income", False) for result in results],
+    }, dtype=object)
+    # Updated logic for needs_manual_input:
+    resolved['needs_manual_input'] = ~(resolved['Main Category'].astype(bool) & resolved['Subcategory'].astype(bool))
+    for col in resolved.columns:
+        values = df[col].to_numpy(dtype=object, copy=True)
+        values[has_text.to_numpy()] = resolved[col].to_numpy().take(codes)
+        df[col] = values
+
+    print(f"\n📈 Summary: {len(df)} processed, {cache_hits} cache hits, {len(uncached)} new texts in {api_calls} API calls.")
+    if failed:
+        print(f"⚠️ {failed} texts could not be categorized; they need manual input and are asked again next run.")
 
     # ==== Detect contract frequency ====
     df = detect_contract_frequency(df)
@@ -267,16 +404,25 @@ def main():
     if 'idx' in df.columns:
       df = df.drop(columns=['idx'])
 
+    return apply_schema(df)
+
+# ==== MAIN FUNCTION ====
+def main():
+    # === Load cleaned transactions ===
+    input_path = CLEANED_FILE
+    output_path = CATEGORIZED_FILE
+    df = categorize_transactions(read_table(input_path))
 
-    # ==== Save as categorized_transactions.csv ====
-    df.to_csv(output_csv, index=False)
-    print(f"✅ Categorized transactions saved as {output_csv}")
+    # ==== Save as categorized_transactions.parquet (+ .csv export) ====
+    written = write_table(df, output_path, export_csv=True)
+    print(f"✅ Categorized transactions saved as {', '.join(written)}")
 
     # ==== OPTIONAL: Upload to Supabase ====
     # Uncomment to upload all records to Supabase 'transactions' table
+    # (keyed by Fingerprint, so re-running does not insert a transaction twice)
     # records = df.to_dict(orient="records")
     # for record in records:
-    #     response = supabase.table("transactions").insert(record).execute()
+    #     response = get_supabase().table("transactions").upsert(record, on_conflict="Fingerprint").execute()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,74 @@
+import os
+import json
+import sqlite3
+
+# ===== Categorization cache =====
+# Gemini's answer per cache key, kept in an SQLite database. Only the keys a
+# run asks about are read, so opening the cache takes the same time however
+# many entries it holds. Every stored batch is its own committed transaction,
+# so a crash or Ctrl-C keeps every result received before it. On first use
+# the entries of the old gemini_memory.json are imported.
+
+CATEGORY_CACHE_FILE = 'gemini_cache.sqlite'
+LEGACY_MEMORY_FILE = 'gemini_memory.json'
+_QUERY_CHUNK = 500  # keys per lookup query, below SQLite's variable limit
+
+class CategoryCache:
+    def __init__(self, path=CATEGORY_CACHE_FILE, legacy_file=LEGACY_MEMORY_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        # Write-ahead log: a commit appends to the log instead of rewriting pages
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS categories (cache_key TEXT PRIMARY KEY, result TEXT NOT NULL) WITHOUT ROWID")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._import_legacy(legacy_file)
+
+    def _import_legacy(self, legacy_file):
+        if not legacy_file or not os.path.exists(legacy_file):
+            return
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_import'").fetchone():
+            return
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                memory = json.load(f)
+        except json.JSONDecodeError as e:
+            print(f"⚠️ Could not import {legacy_file}: {e}")
+            return
+        # Entries and the "imported" mark commit together, so an interrupted
+        # import is simply repeated next time
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO categories VALUES (?, ?)",
+                ((key, json.dumps(result, ensure_ascii=False)) for key, result in memory.items()),
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_import', ?)", (legacy_file,))
+        print(f"📦 Imported {len(memory)} entries from {legacy_file} into {self.path}")
+
+    def get_many(self, keys):
+        """{key: result} for the keys that are cached."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[start:start + _QUERY_CHUNK]
+            rows = self.conn.execute(
+                f"SELECT cache_key, result FROM categories WHERE cache_key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, json.loads(result)) for key, result in rows)
+        return found
+
+    def put_many(self, results):
+        """Store {key: result} and commit."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO categories VALUES (?, ?)",
+                ((key, json.dumps(result, ensure_ascii=False)) for key, result in results.items()),
+            )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,49 +2,97 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 
-def clean_and_harmonize_transactions(input_csv, output_csv):
-    df = pd.read_csv(input_csv)
+from pipeline_io import COMBINED_FILE, CLEANED_FILE, TableWriter, read_table, read_table_chunks, write_table
+from transaction_fingerprint import FINGERPRINT_COLUMN, transaction_fingerprints
+from transaction_schema import MASTER_COLUMNS, apply_schema, without_categories
+
+# Rows per chunk when cleaning in streaming mode; None cleans the whole table at once
+CLEAN_CHUNK_SIZE = None
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y")
+
+def parse_date(x):
+    if pd.isna(x) or not str(x).strip():
+        return ""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(x).split()[0], fmt).strftime("%Y-%m-%d 00:00:00")
+        except Exception:
+            continue
+    try:
+        return pd.to_datetime(x, errors='coerce').strftime("%Y-%m-%d 00:00:00")
+    except Exception:
+        return ""
+
+def harmonize_booking_dates(dates):
+    """parse_date for a whole column: each distinct value is parsed once, format by format, only leftovers go row by row."""
+    codes, uniques = pd.factorize(dates)
+    values = pd.Series(uniques, dtype=object)
+    text = values.astype(str)
+    result = np.full(len(values), "", dtype=object)
+    pending = (text.str.strip() != "").to_numpy()
+    token = text.str.extract(r"^\s*(\S+)", expand=False)
+    for fmt in DATE_FORMATS:
+        if not pending.any():
+            break
+        if " " in fmt:
+            continue  # parse_date only looks at the first word, so this format never matches
+        parsed = pd.to_datetime(token[pending], format=fmt, errors='coerce')
+        matched = parsed.notna().to_numpy()
+        rows = np.flatnonzero(pending)[matched]
+        days = parsed[matched].to_numpy().astype("datetime64[D]").astype(str)
+        result[rows] = np.char.add(days, " 00:00:00")
+        pending[rows] = False
+    if pending.any():
+        # Out-of-range dates and anything else pandas would not parse with a fixed format
+        result[pending] = values[pending].map(parse_date).to_numpy()
+    # factorize gives missing values the code -1
+    return pd.Series(np.append(result, "")[codes], index=dates.index, dtype=object)
+
+def add_calendar_fields(df):
+    """Week ("2024-07", ISO week number), Month ("2024-02"), Quarter ("2024-Q1") and Year from the harmonized Booking Date."""
+    dates = pd.to_datetime(df['Booking Date'].astype(str).str[:10], format="%Y-%m-%d", errors='coerce')
+    known = dates.notna()
+    year = dates.dt.year.astype('Int64').astype(str)
+    fields = {
+        'Week': year + "-" + dates.dt.isocalendar().week.astype('Int64').astype(str).str.zfill(2),
+        'Month': year + "-" + dates.dt.month.astype('Int64').astype(str).str.zfill(2),
+        'Quarter': year + "-Q" + dates.dt.quarter.astype('Int64').astype(str),
+        'Year': year,
+    }
+    for col, values in fields.items():
+        df[col] = values.where(known, "").astype(object)
+    return df
+
+def clean_chunk(df, first_idx=1, fingerprint_counts=None):
+    """Clean one DataFrame (the whole table or one chunk of it); idx numbering starts at first_idx."""
+    # Cleaning fills and rewrites values freely; the schema dtypes are applied again at the end
+    df = without_categories(df)
 
     # Remove index columns accidentally saved in CSV
     for col in df.columns:
         if col.lower() in ['unnamed: 0', 'index']:
             df = df.drop(columns=[col])
 
-    # Drop/ignore any Balance column (not needed at this step)
-    if 'Balance (€)' in df.columns:
-        df = df.drop(columns=['Balance (€)'])
+    # Fingerprint (primary key) for combined tables written before it existed
+    if FINGERPRINT_COLUMN not in df.columns:
+        df[FINGERPRINT_COLUMN] = transaction_fingerprints(df, counts=fingerprint_counts)
 
     # Harmonize Booking Date to yyyy-mm-dd 00:00:00
     if 'Booking Date' in df.columns:
-        def parse_date(x):
-            if pd.isna(x) or not str(x).strip():
-                return ""
-            for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y"):
-                try:
-                    return datetime.strptime(str(x).split()[0], fmt).strftime("%Y-%m-%d 00:00:00")
-                except Exception:
-                    continue
-            try:
-                return pd.to_datetime(x, errors='coerce').strftime("%Y-%m-%d 00:00:00")
-            except Exception:
-                return ""
-        df['Booking Date'] = df['Booking Date'].apply(parse_date)
+        df['Booking Date'] = harmonize_booking_dates(df['Booking Date'])
 
     # Fill missing columns to master schema
-    master_cols = [
-        'idx','Booking Date','Reference Account','Reference Account Name','Amount (€)','Balance (€)','Currency','Payee','IBAN',
-        'Purpose','E-Reference','Mandate Reference','Creditor ID','Main Category','Subcategory','Contract','Contract Frequency',
-        'Contract ID','Internal Transfer','Excluded from Disposable Income','Transaction Type','Analyzed Amount','Week','Month',
-        'Quarter','Year','Tags','Note','text','payer','needs_manual_input','Source File'
-    ]
-    for col in master_cols:
+    for col in MASTER_COLUMNS:
         if col not in df.columns:
             df[col] = ""
-    # Remove columns not in master_cols
-    df = df[[c for c in master_cols if c in df.columns]]
+    # Remove columns not in MASTER_COLUMNS
+    df = df[[c for c in MASTER_COLUMNS if c in df.columns]]
 
-    # Fill NaNs with correct types
+    # Fill NaNs with correct types (unknown running balances stay empty)
     for col in df.columns:
+        if col == 'Balance (€)':
+            continue
         if df[col].dtype == object:
             df[col] = df[col].fillna("")
         elif np.issubdtype(df[col].dtype, np.number):
@@ -54,8 +102,8 @@ def clean_and_harmonize_transactions(input_csv, output_csv):
         else:
             df[col] = df[col].fillna("")
 
-    # Set idx (row number, starting at 1)
-    df['idx'] = range(1, len(df)+1)
+    # Set idx (row number, starting at 1 for the whole table)
+    df['idx'] = range(first_idx, first_idx + len(df))
 
     # Analyzed Amount: based on Amount (€)
     def get_analyzed_amount(x):
@@ -66,29 +114,14 @@ def clean_and_harmonize_transactions(input_csv, output_csv):
     df['Analyzed Amount'] = df['Amount (€)'].apply(get_analyzed_amount)
 
     # Week, Month, Quarter, Year columns (from Booking Date)
-    def parse_date_for_fields(dtstr):
-        try:
-            dt = pd.to_datetime(dtstr[:10], errors='coerce')
-            if pd.isna(dt):
-                return ("", "", "", "")
-            week = f"{dt.year}-" + f"{dt.isocalendar()[1]:02d}"
-            month = f"{dt.year}-" + f"{dt.month:02d}"
-            quarter = f"{dt.year}-Q{((dt.month-1)//3)+1}"
-            year = str(dt.year)
-            return (week, month, quarter, year)
-        except:
-            return ("", "", "", "")
-    date_fields = df['Booking Date'].apply(parse_date_for_fields)
-    df['Week'] = [w for w,m,q,y in date_fields]
-    df['Month'] = [m for w,m,q,y in date_fields]
-    df['Quarter'] = [q for w,m,q,y in date_fields]
-    df['Year'] = [y for w,m,q,y in date_fields]
+    df = add_calendar_fields(df)
 
     # Clean bool columns to True/False, string to "", etc.
     bool_cols = ['Contract','Internal Transfer','Excluded from Disposable Income','needs_manual_input']
     for col in bool_cols:
         if col in df.columns:
-            df[col] = df[col].astype(str).str.lower().map({'true':True, 'false':False, '1':True, '0':False, 'yes':True, 'no':False, '':False, None:False}).fillna(False)
+            # 'true', '1' and 'yes' are True; 'false', '0', 'no', '' and anything else False
+            df[col] = df[col].astype(str).str.lower().isin(['true', '1', 'yes'])
 
     # Final default fill
     columns_to_clean = [
@@ -100,37 +133,44 @@ def clean_and_harmonize_transactions(input_csv, output_csv):
         df[col] = df[col].replace(["0", "0.0", 0], "", regex=False)
         df[col] = df[col].replace(r"^\s*0(\.0)?\s*$", "", regex=True)
 
-    # Fill NaN for object (string) columns
-    string_cols = df.select_dtypes(include='object').columns
-    df[string_cols] = df[string_cols].fillna("")
-
-    # Fill NaN for numeric columns
-    numeric_cols = df.select_dtypes(include=['number']).columns
-    df[numeric_cols] = df[numeric_cols].fillna(0)
-
-    # Fill NaN for boolean columns
-    bool_cols = df.select_dtypes(include='bool').columns
-    df[bool_cols] = df[bool_cols].fillna(False)
+    # (Every column was filled above and the columns derived since never hold NaN,
+    # so there is no need for another pass over each dtype)
 
     # --- Always reconstruct 'text' as "Payee Purpose" (space separated, both cleaned of NaN/0/empty) ---
-    def safe_str(x):
-      if pd.isna(x) or str(x).strip() in ["0", "0.0"]:
-        return ""
-      return str(x).strip()
-
-    df["text"] = df.apply(lambda row: f"{safe_str(row.get('Payee', ''))} {safe_str(row.get('Purpose', ''))}".strip(), axis=1)
-
-    
+    def safe_str(values):
+      text = values.astype(str).str.strip().where(values.notna(), "")
+      return text.where(~text.isin(["0", "0.0"]), "")
+
+    df["text"] = (safe_str(df['Payee']) + " " + safe_str(df['Purpose'])).str.strip()
+    return apply_schema(df)
+
+def clean_and_harmonize_transactions(input_path, output_path, chunk_size=CLEAN_CHUNK_SIZE):
+    """Clean the combined table; paths may be .parquet (pipeline) or .csv (export).
+
+    With a chunk_size the input is read, cleaned and appended to the output
+    chunk by chunk, so memory stays bounded however long the history is; the
+    cleaned frame is then not returned (None).
+    """
+    if chunk_size:
+        fingerprint_counts = {}
+        with TableWriter(output_path) as writer:
+            for chunk in read_table_chunks(input_path, chunk_size):
+                writer.write(clean_chunk(chunk, writer.rows + 1, fingerprint_counts))
+        if writer.rows:
+            print(f"✅ Cleaned & harmonized file written to {output_path} ({writer.rows} rows in chunks of {chunk_size})")
+            return None
+
+    df = clean_chunk(read_table(input_path))
 
     # Save cleaned output
-    df.to_csv(output_csv, index=False)
-    print(f"✅ Cleaned & harmonized file written to {output_csv}")
+    write_table(df, output_path)
+    print(f"✅ Cleaned & harmonized file written to {output_path}")
     print(df.head(10))
     return df
 
 # --- Run as script ---
 if __name__ == "__main__":
     # Change these to your actual file names as needed
-    input_csv = "all_bank_transactions_combined.csv"
-    output_csv = "all_bank_transactions_cleaned.csv"
-    clean_and_harmonize_transactions(input_csv, output_csv)
+    input_path = COMBINED_FILE
+    output_path = CLEANED_FILE
+    clean_and_harmonize_transactions(input_path, output_path, chunk_size=CLEAN_CHUNK_SIZE)
@@ -1,41 +1,409 @@
 import os
+import sys
+import json
+import shutil
+import sqlite3
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 
-EXTRACTED_FOLDER = 'extracted_transactions'
-OUTPUT_FILE = 'all_bank_transactions_combined.csv'
-
-csv_files = [
-    os.path.join(EXTRACTED_FOLDER, f)
-    for f in os.listdir(EXTRACTED_FOLDER)
-    if f.endswith('.csv')
-]
-
-dataframes = []
-for csv in csv_files:
-    try:
-        df = pd.read_csv(csv)
-        df['Source File'] = os.path.basename(csv)
-        dataframes.append(df)
-    except Exception as e:
-        print(f"❌ Error reading {csv}: {e}")
-
-if not dataframes:
-    print("No transactions to combine.")
-else:
-    df_combined = pd.concat(dataframes, ignore_index=True, sort=False)
-    df_combined = df_combined.drop_duplicates()
-    master_columns = [
-        'idx', 'Booking Date', 'Reference Account', 'Reference Account Name',
-        'Amount (€)', 'Balance (€)', 'Currency', 'Payee', 'IBAN', 'Purpose',
-        'E-Reference', 'Mandate Reference', 'Creditor ID', 'Main Category',
-        'Subcategory', 'Contract', 'Contract Frequency', 'Contract ID',
-        'Internal Transfer', 'Excluded from Disposable Income', 'Transaction Type',
-        'Analyzed Amount', 'Week', 'Month', 'Quarter', 'Year', 'Tags', 'Note',
-        'text', 'payer', 'needs_manual_input', 'Source File'
-    ]
-    final_cols = [c for c in master_columns if c in df_combined.columns]
-    df_combined = df_combined[final_cols + [c for c in df_combined.columns if c not in final_cols]]
-    df_combined = df_combined.fillna('')
-    df_combined.to_csv(OUTPUT_FILE, index=False)
-    print(f"✅ Combined {len(csv_files)} files into {OUTPUT_FILE}")
-    print(df_combined.head())
+from balance_ledger import account_balance_states, load_balance_history, load_balances, reconstruct_running_balances
+from pipeline_io import EXTRACTED_FOLDER, COMBINED_FILE, EXPORT_CSV, list_tables, read_parts, read_table, write_table
+from transaction_fingerprint import FINGERPRINT_COLUMN, transaction_fingerprints
+from transaction_schema import MASTER_COLUMNS, apply_schema
+
+OUTPUT_FILE = COMBINED_FILE
+
+# --- Incremental combine ---
+# OUTPUT_FILE is a Parquet dataset: a directory of part files that
+# pipeline_io.read_table reads back as one table. combined_index.sqlite
+# remembers every extracted file already merged (size/mtime), the part files
+# and their row counts, the fingerprint of every transaction merged and, per
+# account, the running total after its last merged row, the date of that row
+# and the closing balances it was balanced against. A run only reads the files
+# that are new, looks up just their fingerprints (dropping transactions
+# already merged from an overlapping statement) and writes the rest as one new
+# part file. New rows dated after an account's history are balanced from the
+# stored running total alone; only when they are not (a statement filled in
+# between older ones) or a closing balance dated inside the history changed
+# are that account's earlier rows read, and a part file whose balances changed
+# rewritten. Once there are more than COMPACT_PARTS part files, the newest
+# small ones are merged into one. A changed or deleted file triggers a full
+# rebuild, as does INCREMENTAL = False or running with --full.
+INCREMENTAL = True
+COMBINE_INDEX_FILE = 'combined_index.sqlite'
+COMBINE_INDEX_VERSION = '4'
+LEGACY_STATE_FILE = 'combined_state.json'  # the JSON state of earlier versions
+BALANCE_COLUMNS = ['Reference Account', 'Booking Date', 'Amount (€)', 'Balance (€)']
+COMPACT_PARTS = 16  # part files allowed before the newest small ones are merged
+COMPACT_PART_ROWS = 500_000  # parts with at least this many rows are left as they are
+_QUERY_CHUNK = 500  # keys per lookup query, below SQLite's variable limit
+
+class CombineIndex:
+    """What OUTPUT_FILE holds, in SQLite: merged files, part files, fingerprints and per-account running totals."""
+    def __init__(self, path=COMBINE_INDEX_FILE):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self._create_tables()
+
+    def _create_tables(self):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS parts (name TEXT PRIMARY KEY, rows INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS accounts (account TEXT PRIMARY KEY, last_date TEXT, total REAL, anchors TEXT)")
+
+    def is_current(self, output):
+        """True if the index was built by this version, for output."""
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        return meta.get("version") == COMBINE_INDEX_VERSION and meta.get("output") == output
+
+    def reset(self, output):
+        with self.conn:
+            # Dropped rather than emptied: an index of an earlier version may have other columns
+            for table in ("meta", "files", "parts", "fingerprints", "accounts"):
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self._create_tables()
+            self.conn.executemany("INSERT INTO meta VALUES (?, ?)", [("version", COMBINE_INDEX_VERSION), ("output", output)])
+
+    def files(self):
+        """{file name: (size, mtime_ns)} of the merged files."""
+        return {name: (size, mtime_ns) for name, size, mtime_ns in self.conn.execute("SELECT name, size, mtime_ns FROM files")}
+
+    def parts(self):
+        """[(part file name, rows)] in table order."""
+        return self.conn.execute("SELECT name, rows FROM parts ORDER BY name").fetchall()
+
+    def _select_in(self, query, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), _QUERY_CHUNK):
+            chunk = keys[start:start + _QUERY_CHUNK]
+            yield from self.conn.execute(query.format(','.join('?' * len(chunk))), chunk)
+
+    def known(self, fingerprints):
+        """The fingerprints among the given ones that are already merged."""
+        return {fp for (fp,) in self._select_in("SELECT fingerprint FROM fingerprints WHERE fingerprint IN ({})", fingerprints)}
+
+    def account_states(self, accounts):
+        """{account: (last booking date, running total, [(anchor date, closing balance)])} for the given accounts."""
+        return {
+            account: (pd.Timestamp(last_date), total, [(pd.Timestamp(d), b) for d, b in json.loads(anchors)])
+            for account, last_date, total, anchors in self._select_in(
+                "SELECT account, last_date, total, anchors FROM accounts WHERE account IN ({})", accounts)
+        }
+
+    def record(self, files, part, rows, fingerprints, accounts):
+        """Remember files ({name: (size, mtime_ns)}) as merged into part (None: no new rows), in one transaction."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                  ((name, size, mtime_ns) for name, (size, mtime_ns) in files.items()))
+            if part is not None:
+                self.conn.execute("INSERT INTO parts VALUES (?, ?)", (part, rows))
+            # Sorted, the inserts append to the B-tree instead of landing all over it
+            self.conn.executemany("INSERT OR IGNORE INTO fingerprints VALUES (?)", ((fp,) for fp in sorted(fingerprints)))
+            self.conn.executemany("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)", (
+                (account, last_date.isoformat(), total, json.dumps([(d.isoformat(), b) for d, b in anchors]))
+                for account, (last_date, total, anchors) in accounts.items()
+            ))
+
+    def replace_parts(self, old_parts, part, rows):
+        with self.conn:
+            self.conn.executemany("DELETE FROM parts WHERE name = ?", ((name,) for name in old_parts))
+            self.conn.execute("INSERT INTO parts VALUES (?, ?)", (part, rows))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def order_columns(df):
+    final_cols = [c for c in MASTER_COLUMNS if c in df.columns]
+    return df[final_cols + [c for c in df.columns if c not in final_cols]]
+
+def _start_over(index):
+    """Drop the combined table and its index (including the layout of earlier versions)."""
+    if os.path.isdir(OUTPUT_FILE):
+        shutil.rmtree(OUTPUT_FILE)
+    elif os.path.exists(OUTPUT_FILE):
+        os.remove(OUTPUT_FILE)
+    if os.path.exists(LEGACY_STATE_FILE):
+        os.remove(LEGACY_STATE_FILE)
+    os.makedirs(OUTPUT_FILE)
+    index.reset(OUTPUT_FILE)
+
+def _part_path(part):
+    return os.path.join(OUTPUT_FILE, part)
+
+def _remove_orphan_parts(index):
+    # Part files written (or merged away) by a run that stopped before updating the index
+    recorded = {part for part, _ in index.parts()}
+    for name in os.listdir(OUTPUT_FILE):
+        if name not in recorded:
+            os.remove(_part_path(name))
+
+def _write_part(df, path):
+    # Write-then-rename: a part file is either complete or not there
+    tmp_path = f"{path}.tmp"
+    write_table(df, tmp_path, export_csv=False)
+    os.replace(tmp_path, path)
+
+def _next_part_name(index):
+    numbers = [int(part[5:-8]) for part, _ in index.parts()]
+    return f"part-{max(numbers, default=0) + 1:06d}.parquet"
+
+def _compact(index):
+    """Merge the newest small part files into one once there are more than COMPACT_PARTS."""
+    parts = index.parts()
+    if len(parts) <= COMPACT_PARTS:
+        return
+    run = []
+    for part, rows in reversed(parts):
+        if rows >= COMPACT_PART_ROWS:
+            break
+        run.insert(0, part)
+    if len(run) < 2:
+        return
+    # The run is the end of the table, so the merged part takes the next
+    # number; until the index says otherwise, it is an orphan
+    merged = _next_part_name(index)
+    df = read_parts([_part_path(part) for part in run])
+    _write_part(df, _part_path(merged))
+    index.replace_parts(run, merged, len(df))
+    for part in run:
+        os.remove(_part_path(part))
+    print(f"🗜️ Merged {len(run)} part files into {merged}")
+
+def _account_states(df, history, balances):
+    """Index state (last date, running total, closing balances) of the accounts in df, which holds their whole history."""
+    return {
+        account: (row.last_date, row.total, row.anchors)
+        for account, row in account_balance_states(df, history, balances).iterrows()
+    }
+
+def _can_append(state, first_date, anchors):
+    """True if new rows of an account, the earliest dated first_date, leave its merged rows' balances as they are.
+
+    That is the case when they all come after the merged rows, the closing
+    balances dated before them are the ones the merged rows were balanced
+    against, and one of those is dated on or after the last merged row (so no
+    merged row is balanced against a later statement that includes new rows).
+    """
+    last_date, _, merged_anchors = state
+    if not anchors:
+        return True  # nothing to balance against
+    if first_date <= last_date:
+        return False
+    if [a for a in merged_anchors if a[0] < first_date] != [a for a in anchors if a[0] < first_date]:
+        return False
+    return any(last_date <= anchor_date < first_date for anchor_date, _ in anchors)
+
+def _rebalance_history(index, df_new, history, balances):
+    """Running balances of the accounts in df_new over their whole history.
+
+    Only the balance columns of those accounts are read from the part files; a
+    part file is rewritten only if one of its balances changed. Returns the
+    balances of df_new's rows and the new index state of the accounts.
+    """
+    accounts = set(df_new['Reference Account'].astype(str))
+    merged = []  # (part path, row positions in the part, balance columns of those rows)
+    for part, _ in index.parts():
+        path = _part_path(part)
+        columns = [c for c in BALANCE_COLUMNS if c in pq.read_schema(path).names]
+        if 'Reference Account' not in columns:
+            continue
+        rows_read = pd.read_parquet(path, columns=columns)
+        rows = np.flatnonzero(rows_read['Reference Account'].astype(str).isin(accounts).to_numpy())
+        if len(rows):
+            merged.append((path, rows, rows_read.iloc[rows]))
+
+    # Same row order as in the combined table, which reconstruct_running_balances relies on
+    new_columns = [c for c in BALANCE_COLUMNS if c in df_new.columns]
+    touched = pd.concat([rows for _, _, rows in merged] + [df_new[new_columns]], ignore_index=True, sort=False)
+    states = _account_states(touched, history, balances)
+    touched = reconstruct_running_balances(touched, history, balances)
+    if 'Balance (€)' not in touched.columns:
+        return None, states
+    balances_out = pd.to_numeric(touched['Balance (€)'], errors='coerce').to_numpy(dtype='float64')
+
+    start = 0
+    for path, rows, old in merged:
+        new = balances_out[start:start + len(rows)]
+        start += len(rows)
+        if 'Balance (€)' in old.columns:
+            current = pd.to_numeric(old['Balance (€)'], errors='coerce').to_numpy(dtype='float64')
+        else:
+            current = np.full(len(rows), np.nan)
+        if ((current == new) | (np.isnan(current) & np.isnan(new))).all():
+            continue
+        part = pd.read_parquet(path)
+        values = pd.to_numeric(part['Balance (€)'], errors='coerce').to_numpy(dtype='float64', copy=True) \
+            if 'Balance (€)' in part.columns else np.full(len(part), np.nan)
+        values[rows] = new
+        part['Balance (€)'] = values
+        _write_part(apply_schema(order_columns(part)), path)
+    return balances_out[start:], states
+
+def _append_balances(df_new, states, history, balances, new_states):
+    """Running balances of df_new's rows, continuing from the accounts' stored running totals.
+
+    Each account's merged rows stand in as one row: the running total at its
+    last booking date. new_states is the index state of the accounts without
+    merged rows. Returns the balances and the new index state of the accounts.
+    """
+    carry = pd.DataFrame(
+        [(account, last_date.strftime('%Y-%m-%d'), total) for account, (last_date, total, _) in states.items()],
+        columns=['Reference Account', 'Booking Date', 'Amount (€)'],
+    )
+    new_columns = [c for c in BALANCE_COLUMNS if c in df_new.columns]
+    frame = df_new[new_columns].reset_index(drop=True)
+    if len(carry):
+        frame = pd.concat([carry, frame], ignore_index=True, sort=False)
+        new_states = {**new_states, **_account_states(frame, history, balances)}
+    frame = reconstruct_running_balances(frame, history, balances)
+    if 'Balance (€)' not in frame.columns:
+        return None, new_states
+    return pd.to_numeric(frame['Balance (€)'], errors='coerce').to_numpy(dtype='float64')[len(carry):], new_states
+
+def _update_running_balances(index, df_new, merged):
+    """Fill the running balances of df_new's rows (and of earlier rows they change).
+
+    Returns df_new and the new index state of its accounts.
+    """
+    if 'Reference Account' not in df_new.columns:
+        return reconstruct_running_balances(df_new), {}
+    history, balances = load_balance_history(), load_balances()
+    new = account_balance_states(df_new, history, balances)
+    states = index.account_states(new.index) if merged else {}
+    rebalance = {
+        account for account, row in new.iterrows()
+        if account in states and not _can_append(states[account], row.first_date, row.anchors)
+    }
+
+    accounts = df_new['Reference Account'].astype(str)
+    if 'Balance (€)' in df_new.columns:
+        values = pd.to_numeric(df_new['Balance (€)'], errors='coerce').to_numpy(dtype='float64', copy=True)
+    else:
+        values = np.full(len(df_new), np.nan)
+    rebalanced = accounts.isin(rebalance).to_numpy()
+    results = []
+    if rebalanced.any():
+        results.append((rebalanced, _rebalance_history(index, df_new[rebalanced], history, balances)))
+    if not rebalanced.all():
+        appended = df_new[~rebalanced]
+        carried = {account: states[account] for account in set(accounts[~rebalanced]) if account in states}
+        # Accounts without merged rows: df_new is their whole history
+        without_history = {
+            account: (row.last_date, row.total, row.anchors)
+            for account, row in new.iterrows() if account not in carried and account not in rebalance
+        }
+        results.append((~rebalanced, _append_balances(appended, carried, history, balances, without_history)))
+
+    new_states = {}
+    filled_any = False
+    for rows, (filled, account_states) in results:
+        new_states.update(account_states)
+        if filled is not None:
+            values[rows] = filled
+            filled_any = True
+    if filled_any or 'Balance (€)' in df_new.columns:
+        df_new = df_new.copy(deep=False)
+        df_new['Balance (€)'] = values
+    return df_new, new_states
+
+def combine_transactions(incremental=INCREMENTAL, extracted=None, load_result=True):
+    """Merge the extracted statements into OUTPUT_FILE.
+
+    Returns the whole combined frame, or with load_result=False only the rows
+    added by this run; None if the combined table is empty. extracted maps
+    extracted file names to DataFrames already in memory (as returned by
+    process_new_transactions); those files are not read again.
+    """
+    extracted = extracted or {}
+
+    # Parquet from process_all_transactions; CSV only for statements extracted before that
+    current = {}
+    for path in list_tables(EXTRACTED_FOLDER):
+        st = os.stat(path)
+        current[os.path.basename(path)] = (path, st.st_size, st.st_mtime_ns)
+
+    with CombineIndex() as index:
+        merged = {}
+        if incremental and index.is_current(OUTPUT_FILE) and os.path.isdir(OUTPUT_FILE):
+            merged = index.files()
+        new_paths = [
+            path for name, (path, size, mtime_ns) in current.items()
+            if merged.get(name) != (size, mtime_ns)
+        ]
+        # A changed or deleted file may have hidden duplicates in other files: start over
+        if any(name not in current or current[name][0] in new_paths for name in merged):
+            print("🔄 Merged statements changed, rebuilding the combined table")
+            merged = {}
+            new_paths = [path for path, _, _ in current.values()]
+        if not merged:
+            _start_over(index)
+        else:
+            _remove_orphan_parts(index)
+
+        if merged and not new_paths:
+            print(f"✅ {OUTPUT_FILE} is up to date ({len(merged)} files merged)")
+            return read_table(OUTPUT_FILE) if load_result else pd.DataFrame()
+
+        new_frames = []
+        new_files = {}
+        new_fingerprints = []
+        seen = set()  # fingerprints added by this run
+        for path in new_paths:
+            name = os.path.basename(path)
+            if name in extracted:
+                df = extracted[name].copy(deep=False)
+            else:
+                try:
+                    df = read_table(path)
+                except Exception as e:
+                    # Not remembered as merged, so the next run tries again
+                    print(f"❌ Error reading {path}: {e}")
+                    continue
+            df['Source File'] = name
+            df[FINGERPRINT_COLUMN] = fingerprints = transaction_fingerprints(df)
+            # Transactions already in the combined table: only this file's fingerprints are looked up
+            known = index.known(fingerprints) if merged else set()
+            keep = ~(fingerprints.isin(known) | fingerprints.isin(seen))
+            added = fingerprints[keep].tolist()
+            seen.update(added)
+            new_fingerprints.extend(added)
+            if keep.any():
+                new_frames.append(df[keep.to_numpy()])
+            _, size, mtime_ns = current[name]
+            new_files[name] = (size, mtime_ns)
+
+        df_new = pd.concat(new_frames, ignore_index=True, sort=False) if new_frames else pd.DataFrame()
+        part = None
+        account_states = {}
+        if len(df_new):
+            df_new, account_states = _update_running_balances(index, df_new, merged)
+            df_new = apply_schema(order_columns(df_new))
+            part = _next_part_name(index)
+            # Missing values stay NaN: clean_transactions fills them per column type
+            _write_part(df_new, _part_path(part))
+        index.record(new_files, part, len(df_new), new_fingerprints, account_states)
+        _compact(index)
+        files_merged = len(merged) + len(new_files)
+        has_rows = bool(index.parts())
+
+    if not has_rows:
+        print("No transactions to combine.")
+        return None
+    print(f"✅ Combined {len(new_files)} new files into {OUTPUT_FILE} ({files_merged} files, {len(df_new)} new rows)")
+    if EXPORT_CSV:
+        read_table(OUTPUT_FILE).to_csv(os.path.splitext(OUTPUT_FILE)[0] + '.csv', index=False)
+    # Without earlier rows the new rows are the whole table
+    return read_table(OUTPUT_FILE) if load_result and merged else df_new
+
+if __name__ == "__main__":
+    df_new = combine_transactions(incremental=INCREMENTAL and "--full" not in sys.argv[1:], load_result=False)
+    if df_new is not None and len(df_new):
+        print(df_new.head())
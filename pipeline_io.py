@@ -0,0 +1,155 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from transaction_schema import SCHEMA, apply_schema
+
+# ===== Intermediate files between pipeline stages =====
+# Extraction, combine, cleaning and categorization hand their data to the next
+# stage as Parquet, so column types (floats, booleans, dates) survive every hop
+# and loading is fast. CSV is an export format: pass a .csv path, or set
+# EXPORT_CSV to write a .csv copy next to every Parquet file. A table can also
+# be a Parquet dataset: a directory of part files (the combined table, which
+# grows by one part per combine run until its small parts are merged), read
+# back as one table in part order.
+
+EXTRACTED_FOLDER = 'extracted_transactions'
+COMBINED_FILE = 'all_bank_transactions_combined.parquet'
+CLEANED_FILE = 'all_bank_transactions_cleaned.parquet'
+CATEGORIZED_FILE = 'categorized_transactions.parquet'
+
+EXPORT_CSV = False
+
+TABLE_EXTENSIONS = ('.parquet', '.csv')
+
+def _arrow_safe(df):
+    """Turn object columns that mix strings with other values into strings (Parquet needs one type per column)."""
+    mixed = [
+        col for col in df.columns
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) in ('mixed', 'mixed-integer')
+    ]
+    if not mixed:
+        return df
+    df = df.copy()
+    for col in mixed:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def _csv_text_dtypes():
+    # Text columns are read as text: left to inference, a column that is empty
+    # in the file (or in one chunk of it) would come back as float
+    return {col: object for col, dtype in SCHEMA.items() if dtype in ("object", "category")}
+
+def list_parts(path):
+    """Part files of the Parquet dataset directory at path, in the order they were written."""
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.parquet'))
+
+def read_parts(paths):
+    """Part files of a Parquet dataset read as one table, in the order given."""
+    parts = [pd.read_parquet(part) for part in paths]
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat(parts, ignore_index=True, sort=False)
+    # Text columns missing from (or empty in) a part come back as NaN; a
+    # single Parquet file gives None
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna(), None)
+    # Categoricals of different parts concatenate to object columns; restore them
+    return apply_schema(df)
+
+def read_table(path):
+    if path.endswith('.csv'):
+        # One pass over the whole file, so a flag column empty at the top is not typed differently further down
+        return pd.read_csv(path, dtype=_csv_text_dtypes(), low_memory=False)
+    if os.path.isdir(path):
+        return read_parts(list_parts(path))
+    return pd.read_parquet(path)
+
+def write_table(df, path, export_csv=None):
+    """Write df to path (.parquet or .csv); returns the paths written."""
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+        return [path]
+    _arrow_safe(df).to_parquet(path, index=False)
+    written = [path]
+    if EXPORT_CSV if export_csv is None else export_csv:
+        csv_path = os.path.splitext(path)[0] + '.csv'
+        df.to_csv(csv_path, index=False)
+        written.append(csv_path)
+    return written
+
+def list_tables(folder):
+    """Table files in folder; when a statement has both .parquet and .csv, only the .parquet is listed."""
+    names = sorted(f for f in os.listdir(folder) if f.endswith(TABLE_EXTENSIONS))
+    bases = {os.path.splitext(f)[0] for f in names if f.endswith('.parquet')}
+    return [
+        os.path.join(folder, f) for f in names
+        if f.endswith('.parquet') or os.path.splitext(f)[0] not in bases
+    ]
+
+def read_table_chunks(path, chunk_size):
+    """Yield the table at path as DataFrames of up to chunk_size rows."""
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=_csv_text_dtypes())
+        return
+    for part in list_parts(path) if os.path.isdir(path) else [path]:
+        parquet = pq.ParquetFile(part)
+        for batch in parquet.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+
+class TableWriter:
+    """Append DataFrames chunk by chunk to one .parquet (or .csv) file.
+
+    The first chunk fixes the Parquet schema; string columns of later chunks
+    are converted to str so they fit it. export_csv works as in write_table.
+    """
+    def __init__(self, path, export_csv=None):
+        self.path = path
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._csv = None
+        if not path.endswith('.csv') and (EXPORT_CSV if export_csv is None else export_csv):
+            self._csv = TableWriter(os.path.splitext(path)[0] + '.csv')
+
+    def write(self, df):
+        if self._csv is not None:
+            self._csv.write(df)
+        if self.path.endswith('.csv'):
+            df.to_csv(self.path, index=False, mode='w' if self.rows == 0 else 'a', header=self.rows == 0)
+        else:
+            df = _arrow_safe(df)
+            if self._writer is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                for i, field in enumerate(schema):
+                    # Columns empty in the first chunk are typed as strings
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, field.with_type(pa.string()))
+                    # Categoricals: later chunks may bring more categories than fit int8 codes
+                    elif pa.types.is_dictionary(field.type):
+                        schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type)))
+                self._schema = schema
+                self._writer = pq.ParquetWriter(self.path, schema)
+            else:
+                df = df.copy()
+                for field in self._schema:
+                    if pa.types.is_string(field.type) and field.name in df and df[field.name].dtype != object:
+                        col = df[field.name]
+                        df[field.name] = col.astype(str).where(col.notna(), None)
+            self._writer.write_table(pa.Table.from_pandas(df, schema=self._schema, preserve_index=False))
+        self.rows += len(df)
+
+    def close(self):
+        if self._csv is not None:
+            self._csv.close()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
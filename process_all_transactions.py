@@ -1,127 +1,234 @@
 import os
 import json
-import pandas as pd
-
-from bank_extractors import (
-    extract_dkb_kontoauszug,
-    extract_n26_statement,
-    extract_db_statement,
-    extract_barclays_excel,
-)
-
-# --- Helper: Robust bank detection (filename + content) ---
-def detect_bank(filename, lines=None):
-    """Detect bank type from filename and content."""
-    name = filename.lower()
-
-    # Excel files (Barclays)
-    if name.endswith(".xlsx"):
-        if "barclays" in name:
-            return "BARCLAYS"
-        try:
-            df = pd.read_excel(filename, header=None, nrows=10)
-            for val in df[0].astype(str):
-                if "barclays" in val.lower():
-                    return "BARCLAYS"
-            if df.shape[1] > 1:
-                for val in df[1].astype(str):
-                    if "barclays" in val.lower():
-                        return "BARCLAYS"
-        except Exception:
-            pass
-        return "UNKNOWN"
-
-    # PDF files
-    if name.endswith(".pdf"):
-        # Filename-based detection
-        if "dkb" in name or "kontoauszug" in name:
-            return "DKB"
-        if "n26" in name:
-            return "N26"
-        if "deutsche" in name or "db" in name or "account_statement" in name:
-            return "DB"
-        # Content-based detection
-        if lines:
-            joined = " ".join(lines).lower()
-            if "deutsche kreditbank" in joined or "dkb" in joined:
-                return "DKB"
-            if ("iban: de15" in joined and "ntsbdeb1xxx" in joined) or \
-               ("pavatharini muthukkumar" in joined and "kontoauszug" in joined):
-                return "N26"
-            if "deutsche bank" in joined:
-                return "DB"
-    return "UNKNOWN"
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bank_extractors import file_sha256, remember_file_sha256, EXTRACTOR_VERSION
+from bank_registry import detect_bank, get_extractor
+from balance_ledger import BalanceLedger
+from pipeline_io import EXTRACTED_FOLDER, write_table
+from transaction_schema import apply_schema
+from run_report import measure
 
 TRANSACTIONS_FOLDER = 'transactions'
 PROCESSED_FILE = 'processed_files.json'
 
+# Number of worker processes used for extraction (1 = run everything in this process)
+MAX_WORKERS = os.cpu_count() or 1
+
+# Formats written for each extracted statement, one file per format.
+# Parquet is what combine_extracted_transactions reads; add "csv" or "xlsx"
+# to also get a copy for checking (to_excel is slow).
+OUTPUT_FORMATS = ("parquet",)
+
+_OUTPUT_WRITERS = {
+    "parquet": lambda df, path: write_table(df, path, export_csv=False),
+    "csv": lambda df, path: df.to_csv(path, index=False),
+    "xlsx": lambda df, path: df.to_excel(path, index=False),
+}
+
+def write_extracted(df, base_path, formats=OUTPUT_FORMATS):
+    """Write one extracted statement in each format; returns the paths written."""
+    paths = []
+    for fmt in formats:
+        path = f"{base_path}.{fmt}"
+        _OUTPUT_WRITERS[fmt](df, path)
+        paths.append(path)
+    return paths
+
+# --- processed_files.json manifest ---
+# Statements are tracked by content hash, so a renamed re-download is not
+# extracted twice and a corrected statement with the same name is picked up.
+# "paths" remembers size/mtime per file path: unchanged files cost one stat and
+# are never read. The manifest is written once per batch.
+MANIFEST_VERSION = 2
+
 def load_processed_files():
+    manifest = {"version": MANIFEST_VERSION, "files": {}, "paths": {}, "legacy_names": []}
     if os.path.exists(PROCESSED_FILE):
         with open(PROCESSED_FILE, 'r') as f:
-            return set(json.load(f))
-    return set()
-
-def save_processed_files(processed_files):
-    with open(PROCESSED_FILE, 'w') as f:
-        json.dump(sorted(list(processed_files)), f, indent=2)
-
-def process_new_transactions():
-    processed_files = load_processed_files()
-    files = os.listdir(TRANSACTIONS_FOLDER)
-    for fname in files:
-        full_path = os.path.join(TRANSACTIONS_FOLDER, fname)
-        if fname in processed_files or not os.path.isfile(full_path):
-            continue
-
-        # --- Read file content for robust detection ---
-        lines = None
-        if fname.lower().endswith('.pdf'):
+            data = json.load(f)
+        if isinstance(data, list):
+            # Old format: plain list of processed file names, migrated as files are seen
+            manifest["legacy_names"] = data
+        else:
+            manifest.update(data)
+    return manifest
+
+def save_processed_files(manifest):
+    tmp_file = f"{PROCESSED_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, PROCESSED_FILE)
+
+def check_processed(manifest, full_path, st):
+    """Return (already_processed, sha256) for a statement file.
+
+    Only hashes the file when its size/mtime differ from what the manifest
+    recorded for that path.
+    """
+    known = manifest["paths"].get(full_path)
+    if known and known["size"] == st.st_size and known["mtime_ns"] == st.st_mtime_ns:
+        sha = known["sha256"]
+    else:
+        sha = file_sha256(full_path)
+        manifest["paths"][full_path] = {"sha256": sha, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    entry = manifest["files"].get(sha)
+    fname = os.path.basename(full_path)
+    if entry is None and fname in manifest["legacy_names"]:
+        entry = manifest["files"][sha] = {
+            "name": fname,
+            "bank": None,
+            "size": st.st_size,
+            "extractor_version": EXTRACTOR_VERSION,
+            "outputs": [],
+        }
+        manifest["legacy_names"].remove(fname)
+    return entry is not None and entry.get("extractor_version") == EXTRACTOR_VERSION, sha
+
+def extract_statement(full_path, file_hash=None):
+    """Detect the bank of one statement file and run its registered extractor.
+
+    This is the unit of work handed to the extraction workers, so it only
+    returns data: (bank, df, error, balances, metrics). Writing the outputs,
+    updating processed_files.json and committing the balances stays with the
+    parent process. metrics holds the time and memory spent on the file.
+    file_hash is (sha256, size, mtime_ns) as check_processed found it, so the
+    page cache does not read the file a second time to hash it.
+    """
+    if file_hash is not None:
+        remember_file_sha256(full_path, *file_hash)
+    with measure() as metrics:
+        bank = detect_bank(full_path)
+        extractor = get_extractor(bank)
+        ledger = BalanceLedger()
+        df, error = None, None
+        if extractor is not None:
             try:
-                import pdfplumber
-                lines = []
-                with pdfplumber.open(full_path) as pdf:
-                    for page in pdf.pages[:2]:  # Just first 2 pages needed
-                        text = page.extract_text()
-                        if text:
-                            lines.extend(text.split('\n'))
+                df = apply_schema(extractor(full_path, ledger=ledger))
             except Exception as e:
-                print(f"[WARN] Could not read PDF: {fname} ({e})")
-        # For Excel, detect_bank already handles reading file
+                error = str(e)
+    metrics.update({"file": os.path.basename(full_path), "bank": bank, "rows_out": len(df) if df is not None else 0})
+    return bank, df, error, ledger.pending if df is not None else [], metrics
 
-        # --- Detect bank ---
-        bank = detect_bank(full_path, lines)
-        print(f"\nProcessing: {fname} | Detected bank: {bank}")
+def _worker_failed(path, error):
+    return "UNKNOWN", None, f"worker failed: {error}", [], {"file": os.path.basename(path)}
 
+def _extract_isolated(job):
+    """extract_statement in a worker of its own, so a crash only fails this file."""
+    with ProcessPoolExecutor(max_workers=1) as pool:
         try:
-            if bank == 'DKB':
-                df = extract_dkb_kontoauszug(full_path)
-            elif bank == 'N26':
-                df = extract_n26_statement(full_path)
-            elif bank == 'DB':
-                df = extract_db_statement(full_path)
-            elif bank == 'BARCLAYS':
-                df = extract_barclays_excel(full_path)
-            else:
+            return pool.submit(extract_statement, *job).result()
+        except Exception as e:
+            return _worker_failed(job[0], e)
+
+def _iter_extraction_results(jobs, max_workers):
+    """Yield (bank, df, error, balances, metrics) for each (path, file_hash) job, in the same order as jobs."""
+    if not max_workers or max_workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield extract_statement(*job)
+        return
+    # A worker that dies (e.g. killed by the OS) breaks the whole pool and
+    # every file still in it. Results that arrived are kept, the first file not
+    # done yet is run again on its own (a crash there is that file's error) and
+    # the rest go to a fresh pool.
+    done = {}
+    next_index = 0
+    while next_index < len(jobs):
+        todo = [i for i in range(next_index, len(jobs)) if i not in done]
+        broken = False
+        with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+            futures = {i: pool.submit(extract_statement, *jobs[i]) for i in todo}
+            for i in range(next_index, len(jobs)):
+                if i not in done:
+                    try:
+                        done[i] = futures[i].result()
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    except Exception as e:
+                        done[i] = _worker_failed(jobs[i][0], e)
+                next_index = i + 1
+                yield done.pop(i)
+            if broken:
+                for i, future in futures.items():
+                    if i > next_index and future.done() and not future.cancelled() and future.exception() is None:
+                        done[i] = future.result()
+        if broken:
+            print(f"⚠️ An extraction worker died; running {os.path.basename(jobs[next_index][0])} on its own")
+            result = _extract_isolated(jobs[next_index])
+            next_index += 1
+            yield result
+
+def process_new_transactions(max_workers=MAX_WORKERS, formats=OUTPUT_FORMATS, report=None):
+    """Extract every new statement; returns {output file name: DataFrame} for the files written.
+
+    With a RunReport, the time and memory of each extractor call is added to it.
+    """
+    unknown = [fmt for fmt in formats if fmt not in _OUTPUT_WRITERS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s): {unknown}")
+    manifest = load_processed_files()
+    pending = []
+    with os.scandir(TRANSACTIONS_FOLDER) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            full_path = os.path.join(TRANSACTIONS_FOLDER, entry.name)
+            st = entry.stat()
+            done, sha = check_processed(manifest, full_path, st)
+            if not done:
+                pending.append((entry.name, full_path, sha, st))
+
+    # The workers get the hashes computed here instead of reading each file again
+    jobs = [(full_path, (sha, st.st_size, st.st_mtime_ns)) for _, full_path, sha, st in pending]
+    results = _iter_extraction_results(jobs, max_workers)
+
+    # Outputs, the manifest and the balances are written here, in file order
+    ledger = BalanceLedger()
+    extracted = {}
+    try:
+        for (fname, full_path, sha, st), (bank, df, error, balances, metrics) in zip(pending, results):
+            if report is not None:
+                report.extractor_calls.append(metrics)
+            print(f"\nProcessing: {fname} | Detected bank: {bank}")
+            if error is not None:
+                print(f"❌ Error processing {fname}: {error}")
+                continue
+            if df is None:
                 print(f"❓ Could not detect bank for file: {fname}. Skipping.")
                 continue
 
-            # Save as CSV and Excel for checking
-            safe_bank = bank if bank != "UNKNOWN" else "UNDETECTED"
-            base_name = fname.rsplit('.', 1)[0]
-            out_csv = f"extracted_{safe_bank}_{base_name}.csv"
-            out_excel = f"extracted_{safe_bank}_{base_name}.xlsx"
-            df.to_csv(os.path.join('extracted_transactions', out_csv), index=False)
-            df.to_excel(os.path.join('extracted_transactions', out_excel), index=False)
-
-            print(f"✅ Processed {fname} and saved to extracted_transactions folder.")
-            processed_files.add(fname)
-            save_processed_files(processed_files)
-
-        except Exception as e:
-            print(f"❌ Error processing {fname}: {e}")
-
-# --- Make sure output folder exists ---
-os.makedirs('extracted_transactions', exist_ok=True)
+            try:
+                safe_bank = bank if bank != "UNKNOWN" else "UNDETECTED"
+                base_name = fname.rsplit('.', 1)[0]
+                outputs = write_extracted(df, os.path.join(EXTRACTED_FOLDER, f"extracted_{safe_bank}_{base_name}"), formats)
+                extracted.update((os.path.basename(path), df) for path in outputs)
+
+                print(f"✅ Processed {fname} ({len(df)} transactions) and saved to extracted_transactions folder.")
+                manifest["files"][sha] = {
+                    "name": fname,
+                    "bank": bank,
+                    "size": st.st_size,
+                    "extractor_version": EXTRACTOR_VERSION,
+                    "outputs": outputs,
+                    "processed_at": datetime.now().isoformat(timespec="seconds"),
+                }
+                ledger.pending.extend(balances)
 
-# --- Run main dispatcher ---
-process_new_transactions()
+            except Exception as e:
+                print(f"❌ Error processing {fname}: {e}")
+    finally:
+        save_processed_files(manifest)
+        if ledger.commit():
+            print("💾 Saved closing balances to last_balance.json")
+    return extracted
+
+if __name__ == "__main__":
+    # --- Make sure output folder exists ---
+    os.makedirs(EXTRACTED_FOLDER, exist_ok=True)
+
+    # --- Run main dispatcher ---
+    process_new_transactions()
@@ -0,0 +1,56 @@
+import time
+import random
+import threading
+
+# ===== Rate limiting =====
+# A token bucket shared by the threads that call an API, and retries with
+# exponential backoff for the errors that say "try again later": rate limiting
+# (HTTP 429) and server errors (5xx).
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to capacity. Thread-safe.
+
+    A rate of 0 or None means no limit.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until it is available."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative: each caller reserves its slot and sleeps
+            # until then, so waiting threads are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+def is_retryable(error):
+    """True for rate limiting (429) and server errors (5xx)."""
+    # google.api_core errors carry the HTTP status as .code, requests-style errors as .status_code
+    for attr in ("code", "status_code"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status == 429 or 500 <= status <= 599
+    return False
+
+def call_with_backoff(func, max_retries=5, base_delay=2.0, max_delay=60.0):
+    """Call func(), retrying retryable errors after base_delay, 2*base_delay, ... (with jitter)."""
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"⏳ {type(e).__name__}: retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+            time.sleep(delay)
@@ -0,0 +1,98 @@
+import os
+import sys
+
+from process_all_transactions import process_new_transactions
+from combine_extracted_transactions import combine_transactions, INCREMENTAL
+from clean_transactions import clean_chunk
+from pipeline_io import EXTRACTED_FOLDER, COMBINED_FILE, CLEANED_FILE, CATEGORIZED_FILE, read_table, write_table
+from run_report import RunReport, RUN_REPORT_FILE
+
+# ===== Pipeline runner =====
+# Runs extraction, combine, cleaning and categorization in one process. Each
+# stage hands its DataFrame to the next in memory; a stage that runs without
+# its predecessor reads the predecessor's file instead. The extracted
+# statements and the combined table are always written (the incremental
+# combine builds on them) and so is the output of the last stage run; the
+# cleaned table of a run that goes on to categorization is only written with
+# checkpoints=True. Every run writes run_report.json with the time, rows and
+# memory of each stage and extractor call (see run_report.py).
+#
+#   python run_pipeline.py                      # all stages
+#   python run_pipeline.py clean categorize     # only these stages
+#   python run_pipeline.py --checkpoints --full # write every stage, rebuild the combined table
+#   python run_pipeline.py --profile=clean      # run the clean stage under cProfile
+
+STAGES = ("extract", "combine", "clean", "categorize")
+
+def _run_stage(stage, df, extracted, checkpoints, last, incremental, record, report):
+    """Run one stage; returns (df, extracted) for the stages after it."""
+    if stage == "extract":
+        os.makedirs(EXTRACTED_FOLDER, exist_ok=True)
+        extracted = process_new_transactions(report=report)
+        # One frame per statement, even when it was written in several formats
+        record["rows_out"] = sum(len(frame) for frame in {id(f): f for f in extracted.values()}.values())
+    elif stage == "combine":
+        # The whole combined table is only read back for the stages after this one
+        df = combine_transactions(incremental=incremental, extracted=extracted, load_result=not last)
+    elif stage == "clean":
+        if df is None:
+            df = read_table(COMBINED_FILE)
+        record["rows_in"] = len(df)
+        df = clean_chunk(df)
+        if checkpoints or last:
+            write_table(df, CLEANED_FILE)
+            print(f"✅ Cleaned & harmonized file written to {CLEANED_FILE}")
+    elif stage == "categorize":
+        # Needs the API keys, so only imported when categorization runs
+        from categorize_and_upload import categorize_transactions
+        if df is None:
+            df = read_table(CLEANED_FILE)
+        record["rows_in"] = len(df)
+        df = categorize_transactions(df)
+        written = write_table(df, CATEGORIZED_FILE, export_csv=True)
+        print(f"✅ Categorized transactions saved as {', '.join(written)}")
+    if stage != "extract":
+        record["rows_out"] = len(df) if df is not None else 0
+    return df, extracted
+
+def run_pipeline(stages=STAGES, checkpoints=False, incremental=INCREMENTAL, report_file=RUN_REPORT_FILE, profile_stage=None):
+    """Run the selected stages in pipeline order; returns the last stage's DataFrame.
+
+    The run report goes to report_file (None: not written); profile_stage runs
+    that stage under cProfile.
+    """
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {unknown} (choose from {', '.join(STAGES)})")
+    selected = [stage for stage in STAGES if stage in stages]
+    if not selected:
+        return None
+
+    report = RunReport(profile_stage)
+    extracted = None
+    df = None
+    try:
+        for stage in selected:
+            print(f"\n▶️ Stage: {stage}")
+            with report.stage(stage, rows_in=len(df) if df is not None else None) as record:
+                df, extracted = _run_stage(stage, df, extracted, checkpoints, stage == selected[-1], incremental, record, report)
+            if stage == "combine" and df is None:
+                print("No transactions to process further.")
+                break
+    finally:
+        print("\n⏱️ Stage timings:")
+        report.print_summary()
+        if report_file:
+            report.write(report_file)
+    return df
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    stages = [arg for arg in args if not arg.startswith("--")] or STAGES
+    profile = [arg.split("=", 1)[1] for arg in args if arg.startswith("--profile=")]
+    run_pipeline(
+        stages,
+        checkpoints="--checkpoints" in args,
+        incremental=INCREMENTAL and "--full" not in args,
+        profile_stage=profile[0] if profile else None,
+    )
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import contextlib
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows: no peak memory figures
+    resource = None
+
+# ===== Run report =====
+# Wall time, CPU time, row counts and peak memory for every pipeline stage and
+# every extractor call, written as JSON after each run_pipeline run. Peak
+# memory is the step's own peak RSS: on Linux the kernel's high-water mark is
+# reset when a step starts (/proc/self/clear_refs) and read when it ends, so a
+# stage that stays below an earlier one still shows its own figure. Elsewhere
+# only the process high-water mark so far is known; "peak_scope" says which of
+# the two a record holds. One stage can be run under cProfile; its stats are
+# saved next to the report and the top functions printed.
+
+RUN_REPORT_FILE = 'run_report.json'
+PROFILE_TOP = 20  # functions printed for a profiled stage
+
+_CLEAR_REFS = "/proc/self/clear_refs"
+_STATUS = "/proc/self/status"
+
+# Peaks seen so far by the measure() blocks still open, outermost first; a
+# nested block resets the high-water mark, so it hands the peak on to them
+_open_peaks = []
+
+def peak_rss_mb():
+    """Process high-water mark (RSS) in MB, None where it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _status_mb(field):
+    try:
+        with open(_STATUS) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    """Start a new high-water mark at the current RSS; returns False where that is not possible."""
+    peak = _status_mb("VmHWM")
+    if peak is None:
+        return False
+    try:
+        with open(_CLEAR_REFS, "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    for peaks in _open_peaks:
+        peaks[0] = max(peaks[0], peak)
+    return True
+
+def _cpu_seconds():
+    # Includes finished child processes, e.g. the extraction workers
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+@contextlib.contextmanager
+def measure():
+    """Yield a dict that gets wall_seconds, cpu_seconds, peak_rss_mb, rss_growth_mb and peak_scope when the block ends.
+
+    peak_scope "step": peak_rss_mb is the block's own peak and rss_growth_mb
+    how far it rose above the RSS at the start. "process": peak_rss_mb is the
+    process high-water mark and rss_growth_mb how much the block raised it.
+    """
+    metrics = {}
+    own_peak = _reset_peak_rss()
+    rss_before = _status_mb("VmRSS") if own_peak else peak_rss_mb()
+    peaks = [rss_before or 0]
+    if own_peak:
+        _open_peaks.append(peaks)
+    wall, cpu = time.perf_counter(), _cpu_seconds()
+    try:
+        yield metrics
+    finally:
+        if own_peak:
+            _open_peaks.pop()  # blocks close innermost first
+            rss_after = max(peaks[0], _status_mb("VmHWM") or 0)
+            for outer in _open_peaks:
+                outer[0] = max(outer[0], rss_after)
+        else:
+            rss_after = peak_rss_mb()
+        metrics.update({
+            "wall_seconds": round(time.perf_counter() - wall, 3),
+            "cpu_seconds": round(_cpu_seconds() - cpu, 3),
+            "peak_rss_mb": rss_after,
+            "rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+            "peak_scope": "step" if own_peak else "process",
+        })
+
+class RunReport:
+    def __init__(self, profile_stage=None):
+        self.profile_stage = profile_stage
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self.extractor_calls = []
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """Measure one stage; set "rows_out" on the yielded record."""
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        try:
+            with measure() as metrics:
+                if profiler:
+                    profiler.enable()
+                try:
+                    yield record
+                finally:
+                    if profiler:
+                        profiler.disable()
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record.update(metrics)
+            if profiler:
+                record["profile"] = self._save_profile(name, profiler)
+            self.stages.append(record)
+
+    def _save_profile(self, name, profiler):
+        path = f"profile_{name}.prof"
+        profiler.dump_stats(path)
+        print(f"\n🔬 Profile of stage '{name}' (top {PROFILE_TOP} by cumulative time, full stats in {path}):")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return path
+
+    def as_dict(self):
+        timed = [s for s in self.stages if s.get("wall_seconds") is not None]
+        slowest = max(timed, key=lambda s: s["wall_seconds"])["stage"] if timed else None
+        return {
+            "started_at": self.started_at,
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "slowest_stage": slowest,
+            "stages": self.stages,
+            "extractor_calls": self.extractor_calls,
+        }
+
+    def write(self, path=RUN_REPORT_FILE):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+        os.replace(tmp_path, path)
+        print(f"📊 Run report written to {path}")
+
+    def print_summary(self):
+        for s in self.stages:
+            rows = f"{s['rows_in'] if s['rows_in'] is not None else '-'} → {s['rows_out'] if s['rows_out'] is not None else '-'}"
+            print(f"   {s['stage']:<11} {s['wall_seconds']:>8.2f}s wall {s['cpu_seconds']:>8.2f}s CPU  rows {rows}  peak {s['peak_rss_mb']} MB{'' if s.get('peak_scope') == 'step' else ' (process high-water mark)'}")
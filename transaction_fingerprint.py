@@ -0,0 +1,55 @@
+import pandas as pd
+
+# ===== Transaction fingerprints =====
+# A compact key per transaction that stays the same whichever statement it
+# came from: a hash of account, booking date, amount (in cents), normalized
+# payee and counterparty IBAN. Identical transactions on the same day (two
+# coffees at the same place) are told apart by their ordinal within the source
+# file, so overlapping statements (a monthly PDF and a quarterly export of the
+# same account) map their rows onto the same fingerprints. combine uses the
+# fingerprint to deduplicate, later stages keep it as the primary key.
+
+FINGERPRINT_COLUMN = 'Fingerprint'
+
+def _text(df, col):
+    if col not in df.columns:
+        return pd.Series('', index=df.index)
+    values = df[col]
+    return values.astype(str).where(values.notna(), '')
+
+def _booking_day(df):
+    raw = _text(df, 'Booking Date').str.strip()
+    day = raw.str[:10]
+    parsed = pd.to_datetime(day, format='%Y-%m-%d', errors='coerce')
+    parsed = parsed.fillna(pd.to_datetime(day, format='%d.%m.%Y', errors='coerce'))
+    return parsed.dt.strftime('%Y-%m-%d').where(parsed.notna(), raw)
+
+def _amount_cents(df):
+    if 'Amount (€)' not in df.columns:
+        return pd.Series('', index=df.index)
+    cents = (pd.to_numeric(df['Amount (€)'], errors='coerce') * 100).round()
+    return cents.astype('Int64').astype(str).where(cents.notna(), '')
+
+def transaction_fingerprints(df, source_col='Source File', counts=None):
+    """Fingerprint per row (16 hex digits); ordinals count within source_col when present.
+
+    When a table is fingerprinted chunk by chunk, pass the same counts dict for
+    every chunk so the ordinals carry on across chunk boundaries.
+    """
+    base = (
+        _text(df, 'Reference Account').str.replace(r'\s+', '', regex=True).str.upper()
+        + '\x1f' + _booking_day(df)
+        + '\x1f' + _amount_cents(df)
+        + '\x1f' + _text(df, 'Payee').str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+        + '\x1f' + _text(df, 'IBAN').str.replace(r'\s+', '', regex=True).str.upper()
+    )
+    group = base
+    if source_col in df.columns:
+        group = _text(df, source_col) + '\x1e' + base
+    ordinal = group.groupby(group, sort=False).cumcount()
+    if counts is not None:
+        ordinal += group.map(counts).fillna(0).astype(int)
+        for key, n in group.value_counts(sort=False).items():
+            counts[key] = counts.get(key, 0) + n
+    keys = base + '\x1f' + ordinal.astype(str)
+    return pd.util.hash_pandas_object(keys, index=False).map('{:016x}'.format)
@@ -0,0 +1,84 @@
+import pandas as pd
+
+from transaction_fingerprint import FINGERPRINT_COLUMN
+
+# ===== Master transaction schema =====
+# Column order and dtype of the master transaction table, shared by every
+# stage. Low-cardinality text columns are categoricals (one small integer per
+# row instead of a Python string), flags are real booleans and amounts float64.
+# "object" columns are free text and left as they are.
+
+SCHEMA = {
+    FINGERPRINT_COLUMN: "object",
+    'idx': "int64",
+    'Booking Date': "object",
+    'Reference Account': "category",
+    'Reference Account Name': "category",
+    'Amount (€)': "float64",
+    'Balance (€)': "float64",
+    'Currency': "category",
+    'Payee': "object",
+    'IBAN': "object",
+    'Purpose': "object",
+    'E-Reference': "object",
+    'Mandate Reference': "object",
+    'Creditor ID': "object",
+    'Main Category': "category",
+    'Subcategory': "category",
+    'Contract': "bool",
+    'Contract Frequency': "category",
+    'Contract ID': "object",
+    'Internal Transfer': "bool",
+    'Excluded from Disposable Income': "bool",
+    'Transaction Type': "category",
+    'Analyzed Amount': "category",
+    'Week': "category",
+    'Month': "category",
+    'Quarter': "category",
+    'Year': "category",
+    'Tags': "object",
+    'Note': "object",
+    'text': "object",
+    'payer': "object",
+    'needs_manual_input': "bool",
+    'Source File': "category",
+}
+
+MASTER_COLUMNS = list(SCHEMA)
+
+def _is_bool_column(values):
+    return values.dtype == bool or pd.api.types.infer_dtype(values, skipna=True) == 'boolean'
+
+def apply_schema(df):
+    """Cast the master columns present in df to their schema dtype; returns a new frame.
+
+    Casts that would lose information are skipped: int64 columns with missing
+    values and bool columns still holding text ("Yes"/"No", normalized by
+    clean_transactions) keep their dtype.
+    """
+    df = df.copy(deep=False)
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns or dtype == "object" or df[col].dtype == dtype:
+            continue
+        values = df[col]
+        if dtype == "category":
+            df[col] = values.astype("category")
+        elif dtype == "float64":
+            df[col] = pd.to_numeric(values, errors='coerce').astype("float64")
+        elif dtype == "int64":
+            if pd.api.types.is_numeric_dtype(values) and values.notna().all():
+                df[col] = values.astype("int64")
+        elif dtype == "bool":
+            if _is_bool_column(values):
+                df[col] = values.astype("boolean").fillna(False).astype(bool)
+    return df
+
+def without_categories(df):
+    """Turn categorical columns back into object columns, for code that fills or sets values row by row."""
+    categorical = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not categorical:
+        return df
+    df = df.copy(deep=False)
+    for col in categorical:
+        df[col] = df[col].astype(object)
+    return df